@@ -0,0 +1,715 @@
+#!/usr/bin/env python
+import os
+import re
+import sys
+import time
+import typing
+import hashlib
+import sqlite3
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# The catalog records what is in a case so that the tools do not have to list
+# and sort the time directories (and processor0) over and over again
+# A directory is only listed again when its mtime changes, which happens when
+# entries are added to or removed from it (but not when a file is rewritten in
+# place so file sizes can lag behind until the time directory changes)
+#
+# The database lives outside the case by default because SQLite locking is
+# unreliable on parallel file systems like Lustre
+# It is just as unreliable on NFS so if $HOME is on NFS (as on most clusters)
+# set CASE_CATALOG_DIR to a node-local directory like /tmp or $TMPDIR
+# If the catalog cannot be used (locked, unwritable or corrupt) the helpers at
+# the bottom of this file fall back to scanning the case directly
+CATALOG_VERSION = 1
+ARCHIVE_PATTERN = re.compile(r"^times_(?P<first>.+)_(?P<last>.+)\.tgz$")
+PICKLE_PATTERN = re.compile(r"^(?P<prefix>.*?)(?P<time>[0-9][0-9.eE+-]*)\.p$")
+# Directories modified this recently may still be changing within the mtime
+# resolution of the file system so they are listed again next time
+MTIME_SETTLE_SECONDS = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS locations (name TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS times (
+    location TEXT NOT NULL,
+    time TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (location, time)
+);
+CREATE TABLE IF NOT EXISTS files (
+    location TEXT NOT NULL,
+    time TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    format TEXT NOT NULL,
+    PRIMARY KEY (location, time, name)
+);
+CREATE TABLE IF NOT EXISTS archives (name TEXT PRIMARY KEY, first TEXT, last TEXT);
+CREATE TABLE IF NOT EXISTS pickles (name TEXT PRIMARY KEY, prefix TEXT, time TEXT);
+"""
+
+
+def _to_time(name: str) -> float | None:
+    try:
+        value = float(name)
+    except ValueError:
+        return None
+    if value != value or value in (float("inf"), float("-inf")):
+        return None
+    return value
+
+
+def _is_processor_dir(name: str) -> bool:
+    return name.startswith("processor") and name[len("processor"):].isdigit()
+
+
+def default_catalog_path(case_dir: Path) -> Path:
+    catalog_dir = Path(os.environ.get(
+        "CASE_CATALOG_DIR",
+        Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "openfoam_utils",
+        ))
+    case_path = str(case_dir.resolve())
+    digest = hashlib.sha1(case_path.encode()).hexdigest()[:12]
+    return catalog_dir / f"{Path(case_path).name}-{digest}.sqlite"
+
+
+def _file_format(filepath: Path) -> str:
+    if filepath.suffix == ".gz":
+        return "compressed"
+    try:
+        with open(filepath, "rb") as infile:
+            header = infile.read(2048)
+    except OSError:
+        return "unknown"
+    match = re.search(rb"\bformat\s+(\w+)\s*;", header)
+    return match[1].decode() if match else "unknown"
+
+
+def _stat_mtime(path: Path) -> int | None:
+    try:
+        return path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _list_time_names(directory: Path) -> list[str]:
+    with os.scandir(directory) as entries:
+        return [
+                entry.name for entry in entries
+                if entry.is_dir() and _to_time(entry.name) is not None
+                ]
+
+
+def _scan_files(directory: Path) -> list[tuple[str, int, str]]:
+    files = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            files.append((
+                entry.name,
+                entry.stat().st_size,
+                _file_format(Path(entry.path)),
+                ))
+    return files
+
+
+class CaseCatalog:
+    # The catalog checks a directory the first time it is asked about while it
+    # is open so that what it returns matches the case
+    # Opening it only checks the case directory (one stat when nothing
+    # changed), the processor directories are checked when their times are
+    # asked for and the files of a time when they are asked for
+    # With refresh=False it only returns what was recorded before
+
+    def __init__(
+            self,
+            case_dir: Path,
+            catalog_path: Path | None = None,
+            num_workers: int = 16,
+            refresh: bool = True,
+            ):
+        self.case_dir = case_dir
+        self.num_workers = num_workers
+        self._auto_refresh = refresh
+        self._checked: set[str] = set()
+        if catalog_path is None:
+            catalog_path = default_catalog_path(case_dir)
+        catalog_path.parent.mkdir(parents=True, exist_ok=True)
+        # Writes are short so waiting much longer than this means something is
+        # wrong with the locking and a direct scan is the better option
+        self._connection = sqlite3.connect(catalog_path, timeout=10)
+        try:
+            with self._connection:
+                self._connection.executescript(SCHEMA)
+                version = self._connection.execute(
+                        "SELECT value FROM metadata WHERE key = 'version'"
+                        ).fetchone()
+                if version is None or int(version[0]) != CATALOG_VERSION:
+                    self._clear()
+                    self._connection.execute(
+                            "INSERT OR REPLACE INTO metadata VALUES ('version', ?)",
+                            (str(CATALOG_VERSION),),
+                            )
+            self._refresh_case()
+        except BaseException:
+            self._connection.close()
+            raise
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __enter__(self) -> "CaseCatalog":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _clear(self) -> None:
+        for table in ["dirs", "locations", "times", "files", "archives", "pickles"]:
+            self._connection.execute(f"DELETE FROM {table}")
+
+    def rebuild(self) -> None:
+        with self._connection:
+            self._clear()
+        self._auto_refresh = True
+        self.refresh()
+
+    def _recorded_mtimes(self) -> dict[str, int]:
+        return dict(self._connection.execute("SELECT path, mtime_ns FROM dirs"))
+
+    def _mtime_to_record(self, mtime_ns: int) -> int:
+        # Record a directory that was modified very recently as never seen so
+        # that a change within the same mtime tick is not missed
+        if time.time() - mtime_ns / 1e9 < MTIME_SETTLE_SECONDS:
+            return 0
+        return mtime_ns
+
+    def refresh(self) -> None:
+        # Bring the case directory and every processor directory up to date
+        # The file inventory is only brought up to date by files()
+        self._checked.clear()
+        self._refresh_case()
+        self._refresh_locations(self.processor_dirs())
+
+    def _refresh_case(self) -> None:
+        # Each location is only checked once while the catalog is open
+        if not self._auto_refresh or "" in self._checked:
+            return
+        recorded = self._connection.execute(
+                "SELECT mtime_ns FROM dirs WHERE path = ''"
+                ).fetchone()
+        case_mtime = _stat_mtime(self.case_dir)
+        if case_mtime is None:
+            raise FileNotFoundError(f"{self.case_dir} does not exist")
+        if recorded is None or recorded[0] != case_mtime:
+            self._refresh_case_entries(case_mtime)
+        self._checked.add("")
+
+    def _refresh_locations(self, locations: list[str]) -> None:
+        # Stat the processor directories in parallel and list the ones that
+        # changed
+        locations = [
+                location for location in locations
+                if location and location not in self._checked
+                ]
+        if not self._auto_refresh or not locations:
+            return
+        recorded = self._recorded_mtimes()
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            location_mtimes = dict(zip(
+                locations,
+                executor.map(
+                    lambda location: _stat_mtime(self.case_dir / location),
+                    locations,
+                    ),
+                ))
+            changed_locations = [
+                    location for location, mtime in location_mtimes.items()
+                    if mtime is not None and recorded.get(location) != mtime
+                    ]
+            listed = dict(zip(
+                changed_locations,
+                executor.map(
+                    lambda location: _list_time_names(self.case_dir / location),
+                    changed_locations,
+                    ),
+                ))
+        if listed:
+            with self._connection:
+                for location, names in listed.items():
+                    self._sync_times(location, names)
+                    self._set_mtime(location, location_mtimes[location])
+        self._checked.update(locations)
+
+    def _set_mtime(self, path: str, mtime_ns: int) -> None:
+        self._connection.execute(
+                "INSERT OR REPLACE INTO dirs VALUES (?, ?)",
+                (path, self._mtime_to_record(mtime_ns)),
+                )
+
+    def _sync_times(self, location: str, names: list[str]) -> None:
+        existing = {
+                row[0] for row in self._connection.execute(
+                    "SELECT time FROM times WHERE location = ?", (location,)
+                    )
+                }
+        removed = existing - set(names)
+        self._connection.executemany(
+                "DELETE FROM times WHERE location = ? AND time = ?",
+                [(location, name) for name in removed],
+                )
+        self._connection.executemany(
+                "DELETE FROM files WHERE location = ? AND time = ?",
+                [(location, name) for name in removed],
+                )
+        self._connection.executemany(
+                "DELETE FROM dirs WHERE path = ?",
+                [(str(Path(location) / name),) for name in removed],
+                )
+        self._connection.executemany(
+                "INSERT OR IGNORE INTO times VALUES (?, ?, ?)",
+                [(location, name, _to_time(name)) for name in names],
+                )
+
+    def _refresh_case_entries(self, case_mtime: int) -> None:
+        time_names = []
+        processors = []
+        archives = []
+        pickles = []
+        with os.scandir(self.case_dir) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if _to_time(entry.name) is not None:
+                        time_names.append(entry.name)
+                    elif _is_processor_dir(entry.name):
+                        processors.append(entry.name)
+                elif match := ARCHIVE_PATTERN.match(entry.name):
+                    archives.append((entry.name, match["first"], match["last"]))
+                elif match := PICKLE_PATTERN.match(entry.name):
+                    if _to_time(match["time"]) is not None:
+                        pickles.append((entry.name, match["prefix"], match["time"]))
+        with self._connection:
+            self._sync_times("", time_names)
+            removed_processors = {
+                    row[0] for row in self._connection.execute(
+                        "SELECT name FROM locations WHERE name != ''"
+                        )
+                    } - set(processors)
+            for table, column in [("times", "location"), ("files", "location"), ("locations", "name")]:
+                self._connection.executemany(
+                        f"DELETE FROM {table} WHERE {column} = ?",
+                        [(name,) for name in removed_processors],
+                        )
+            self._connection.executemany(
+                    "DELETE FROM dirs WHERE path = ? OR path LIKE ?",
+                    [(name, f"{name}/%") for name in removed_processors],
+                    )
+            self._connection.executemany(
+                    "INSERT OR IGNORE INTO locations VALUES (?)",
+                    [(name,) for name in ["", *processors]],
+                    )
+            self._connection.execute("DELETE FROM archives")
+            self._connection.executemany(
+                    "INSERT INTO archives VALUES (?, ?, ?)", archives,
+                    )
+            self._connection.execute("DELETE FROM pickles")
+            self._connection.executemany(
+                    "INSERT INTO pickles VALUES (?, ?, ?)", pickles,
+                    )
+            self._set_mtime("", case_mtime)
+
+    def _refresh_files(self, location: str, name: str) -> None:
+        # Scan the files of one time directory again if it changed
+        if not self._auto_refresh:
+            return
+        path = str(Path(location) / name)
+        mtime = _stat_mtime(self.case_dir / path)
+        recorded = self._connection.execute(
+                "SELECT mtime_ns FROM dirs WHERE path = ?", (path,)
+                ).fetchone()
+        if mtime is None or (recorded is not None and recorded[0] == mtime):
+            return
+        files = _scan_files(self.case_dir / path)
+        with self._connection:
+            self._connection.execute(
+                    "DELETE FROM files WHERE location = ? AND time = ?",
+                    (location, name),
+                    )
+            self._connection.executemany(
+                    "INSERT INTO files VALUES (?, ?, ?, ?, ?)",
+                    [(location, name, *f) for f in files],
+                    )
+            self._set_mtime(path, mtime)
+
+    def times(self, start: float | None = None, end: float | None = None) -> list[str]:
+        # The reconstructed times in numerical order
+        return self.location_times("", start, end)
+
+    def location_times(
+            self,
+            location: str,
+            start: float | None = None,
+            end: float | None = None,
+            ) -> list[str]:
+        self._refresh_locations([location])
+        return [
+                row[0] for row in self._connection.execute(
+                    "SELECT time FROM times WHERE location = ? "
+                    "AND value >= ? AND value <= ? ORDER BY value",
+                    (
+                        location,
+                        float("-inf") if start is None else start,
+                        float("inf") if end is None else end,
+                        ),
+                    )
+                ]
+
+    def decomposed_times(
+            self,
+            start: float | None = None,
+            end: float | None = None,
+            ) -> list[str]:
+        # The decomposed times as seen in processor0
+        return self.location_times("processor0", start, end)
+
+    def processor_dirs(self) -> list[str]:
+        processors = [
+                row[0] for row in self._connection.execute(
+                    "SELECT name FROM locations WHERE name != ''"
+                    )
+                ]
+        return sorted(processors, key=lambda p: int(p[len("processor"):]))
+
+    def processor_times(self) -> dict[str, list[str]]:
+        # The times in each processor directory
+        processors = self.processor_dirs()
+        self._refresh_locations(processors)
+        return {
+                processor: self.location_times(processor)
+                for processor in processors
+                }
+
+    def files(self, time: str, location: str = "") -> list[tuple[str, int, str]]:
+        # (name, size, format) of the files in a time directory
+        # The files are only scanned when they are asked for and again when
+        # the time directory changes (but not when a file is rewritten in place)
+        self._refresh_files(location, time)
+        return list(self._connection.execute(
+            "SELECT name, size, format FROM files "
+            "WHERE location = ? AND time = ? ORDER BY name",
+            (location, time),
+            ))
+
+    def archives(self) -> list[tuple[str, str, str]]:
+        # (name, first time, last time) of the times_<first>_<last>.tgz archives
+        return list(self._connection.execute(
+            "SELECT name, first, last FROM archives ORDER BY name"
+            ))
+
+    def pickles(self, prefix: str | None = None) -> list[tuple[str, str]]:
+        # (name, time) of the pickles in the case directory
+        rows = self._connection.execute(
+                "SELECT name, prefix, time FROM pickles"
+                ).fetchall()
+        pickles = [
+                (name, t) for name, p, t in rows
+                if prefix is None or p == prefix
+                ]
+        return sorted(pickles, key=lambda entry: float(entry[1]))
+
+    def status(self) -> dict[str, dict[str, bool]]:
+        # Whether each time is decomposed (in every processor directory),
+        # reconstructed and archived
+        processors = self.processor_dirs()
+        self._refresh_locations(processors)
+        num_processors = len(processors)
+        rows = self._connection.execute(
+                "SELECT time, value, "
+                "SUM(location = ''), SUM(location != '') "
+                "FROM times GROUP BY time ORDER BY value"
+                ).fetchall()
+        ranges = [
+                (_to_time(first), _to_time(last))
+                for _, first, last in self.archives()
+                ]
+        return {
+                name: {
+                    "decomposed": num_processors > 0 and decomposed == num_processors,
+                    "reconstructed": bool(reconstructed),
+                    "archived": any(
+                        first is not None and last is not None
+                        and first <= value <= last
+                        for first, last in ranges
+                        ),
+                    }
+                for name, value, reconstructed, decomposed in rows
+                }
+
+
+def _in_range(name: str, start: float | None, end: float | None) -> bool:
+    value = _to_time(name)
+    return (start is None or value >= start) and (end is None or value <= end)
+
+
+class CaseScan:
+    # Answers the same queries as CaseCatalog by scanning the case every time
+    # Used when the catalog database cannot be used
+
+    def __init__(self, case_dir: Path, num_workers: int = 16):
+        self.case_dir = case_dir
+        self.num_workers = num_workers
+
+    def __enter__(self) -> "CaseScan":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+    def location_times(
+            self,
+            location: str,
+            start: float | None = None,
+            end: float | None = None,
+            ) -> list[str]:
+        return sorted(
+                (
+                    name for name in _list_time_names(self.case_dir / location)
+                    if _in_range(name, start, end)
+                    ),
+                key=_to_time,
+                )
+
+    def times(self, start: float | None = None, end: float | None = None) -> list[str]:
+        return self.location_times("", start, end)
+
+    def decomposed_times(
+            self,
+            start: float | None = None,
+            end: float | None = None,
+            ) -> list[str]:
+        return self.location_times("processor0", start, end)
+
+    def processor_dirs(self) -> list[str]:
+        with os.scandir(self.case_dir) as entries:
+            processors = [
+                    entry.name for entry in entries
+                    if entry.is_dir() and _is_processor_dir(entry.name)
+                    ]
+        return sorted(processors, key=lambda p: int(p[len("processor"):]))
+
+    def processor_times(self) -> dict[str, list[str]]:
+        processors = self.processor_dirs()
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            return dict(zip(processors, executor.map(self.location_times, processors)))
+
+    def files(self, time: str, location: str = "") -> list[tuple[str, int, str]]:
+        return sorted(_scan_files(self.case_dir / location / time))
+
+    def archives(self) -> list[tuple[str, str, str]]:
+        archives = []
+        for name in os.listdir(self.case_dir):
+            if match := ARCHIVE_PATTERN.match(name):
+                archives.append((name, match["first"], match["last"]))
+        return sorted(archives)
+
+    def pickles(self, prefix: str | None = None) -> list[tuple[str, str]]:
+        pickles = []
+        for name in os.listdir(self.case_dir):
+            match = PICKLE_PATTERN.match(name)
+            if match is None or _to_time(match["time"]) is None:
+                continue
+            if prefix is None or match["prefix"] == prefix:
+                pickles.append((name, match["time"]))
+        return sorted(pickles, key=lambda entry: float(entry[1]))
+
+    def status(self) -> dict[str, dict[str, bool]]:
+        reconstructed = set(self.times())
+        processor_times = self.processor_times()
+        decomposed_counts: dict[str, int] = {}
+        for times in processor_times.values():
+            for name in times:
+                decomposed_counts[name] = decomposed_counts.get(name, 0) + 1
+        ranges = [
+                (_to_time(first), _to_time(last))
+                for _, first, last in self.archives()
+                ]
+        names = sorted(reconstructed | set(decomposed_counts), key=_to_time)
+        return {
+                name: {
+                    "decomposed": bool(processor_times)
+                    and decomposed_counts.get(name, 0) == len(processor_times),
+                    "reconstructed": name in reconstructed,
+                    "archived": any(
+                        first is not None and last is not None
+                        and first <= _to_time(name) <= last
+                        for first, last in ranges
+                        ),
+                    }
+                for name in names
+                }
+
+
+T = typing.TypeVar("T")
+
+
+def query_case(
+        case_dir: Path,
+        query: typing.Callable[[typing.Any], T],
+        catalog_path: Path | None = None,
+        num_workers: int = 16,
+        ) -> T:
+    # Run query on the catalog of the case or on a direct scan of the case if
+    # the catalog cannot be used
+    try:
+        catalog = CaseCatalog(case_dir, catalog_path, num_workers=num_workers)
+    except (sqlite3.Error, OSError) as error:
+        _warn_scanning(case_dir, error)
+        return query(CaseScan(case_dir, num_workers=num_workers))
+    try:
+        with catalog:
+            return query(catalog)
+    except sqlite3.Error as error:
+        # The lazy refreshes write to the database too
+        _warn_scanning(case_dir, error)
+        return query(CaseScan(case_dir, num_workers=num_workers))
+
+
+def _warn_scanning(case_dir: Path, error: Exception) -> None:
+    print(
+        f"Cannot use the case catalog ({error}), scanning {case_dir} directly",
+        file=sys.stderr,
+        )
+
+
+def list_times(
+        case_dir: Path,
+        start: float | None = None,
+        end: float | None = None,
+        ) -> list[str]:
+    # The reconstructed times in numerical order
+    return query_case(case_dir, lambda catalog: catalog.times(start, end))
+
+
+def list_pickles(case_dir: Path, prefix: str) -> list[Path]:
+    # The <prefix><time>.p pickles in the case directory in time order
+    return [
+            case_dir / name
+            for name, _ in query_case(case_dir, lambda catalog: catalog.pickles(prefix))
+            ]
+
+
+def _print_query(args: argparse.Namespace, catalog: CaseCatalog | CaseScan) -> None:
+    # Collect everything before printing so that a fallback to a direct scan
+    # after a failure part way through does not print anything twice
+    lines = []
+    if args.command == 'times':
+        if args.decomposed:
+            lines = catalog.decomposed_times(args.start, args.end)
+        else:
+            lines = catalog.times(args.start, args.end)
+    elif args.command == 'fields':
+        location = 'processor0' if args.decomposed else ''
+        lines = [
+                f'{name:<24s} {size:>14d}  {file_format}'
+                for name, size, file_format in catalog.files(args.timestamp, location)
+                ]
+    elif args.command == 'status':
+        lines = [f'{"time":<16s} decomposed reconstructed archived']
+        for t, flags in catalog.status().items():
+            lines.append(
+                f'{t:<16s} {"yes" if flags["decomposed"] else "no":<10s} '
+                f'{"yes" if flags["reconstructed"] else "no":<13s} '
+                f'{"yes" if flags["archived"] else "no"}'
+            )
+    else:
+        raise ValueError(f'Unknown command {args.command}')
+    for line in lines:
+        print(line)
+
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(
+            prog='case_catalog',
+            description='Keep a cached inventory of the times and fields in a case',
+            )
+    parser.add_argument(
+            '--case-dir',
+            type=Path,
+            default=Path('.'),
+            help='the OpenFOAM case directory',
+            )
+    parser.add_argument(
+            '--catalog',
+            type=Path,
+            help='the catalog database (defaults to a file in $CASE_CATALOG_DIR or ~/.cache/openfoam_utils, '
+            'set CASE_CATALOG_DIR to a node-local directory if $HOME is on NFS)',
+            )
+    subparsers = parser.add_subparsers(title='subcommands', dest='command')
+
+    parser_times = subparsers.add_parser(
+            'times',
+            help='Print the times in numerical order',
+            )
+    parser_times.add_argument(
+            '-d',
+            '--decomposed',
+            help='print the decomposed times in processor0 instead of the reconstructed ones',
+            action='store_true',
+            )
+    parser_times.add_argument('-s', '--start', type=float, help='first time to print')
+    parser_times.add_argument('-e', '--end', type=float, help='last time to print')
+
+    parser_fields = subparsers.add_parser(
+            'fields',
+            help='Print the files in a time with their sizes and formats',
+            )
+    parser_fields.add_argument('timestamp', help='the time to print')
+    parser_fields.add_argument(
+            '-d',
+            '--decomposed',
+            help='look in processor0 instead of the reconstructed time',
+            action='store_true',
+            )
+
+    subparsers.add_parser(
+            'status',
+            help='Print whether each time is decomposed, reconstructed and archived',
+            )
+
+    parser_refresh = subparsers.add_parser(
+            'refresh',
+            help='Bring the catalog up to date',
+            )
+    parser_refresh.add_argument(
+            '--rebuild',
+            help='forget everything and scan the whole case again',
+            action='store_true',
+            )
+
+    args = parser.parse_args()
+
+    if args.command == 'refresh':
+        # Nothing to fall back to here so errors with the catalog are raised
+        with CaseCatalog(args.case_dir, args.catalog) as catalog:
+            if args.rebuild:
+                catalog.rebuild()
+            else:
+                catalog.refresh()
+    elif args.command is None:
+        parser.print_usage()
+    else:
+        query_case(
+                args.case_dir,
+                lambda catalog: _print_query(args, catalog),
+                args.catalog,
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import re
+import functools
+import operator
+import typing
+from pathlib import Path
+
+import numpy as np
+import numpy.typing as npt
+
+# A cell selection is given as one or more specs which are intersected
+#   bbox:xmin,ymin,zmin,xmax,ymax,zmax  cells whose centre is inside the box
+#   zone:NAME                           cells in a cellZone of the mesh
+#   FIELD>VALUE (or <, >=, <=)          cells where a field passes a threshold
+# Vector fields are compared using their magnitude
+THRESHOLD_PATTERN = re.compile(
+        r"^\s*(?P<field>[^<>=\s]+)\s*(?P<op><=|>=|<|>)\s*(?P<value>\S+)\s*$"
+        )
+THRESHOLD_OPERATORS = {
+        "<": operator.lt,
+        ">": operator.gt,
+        "<=": operator.le,
+        ">=": operator.ge,
+        }
+
+
+def _read_foam_tokens(filepath: Path) -> list[str]:
+    text = filepath.read_text()
+    # Remove the comments and the FoamFile header
+    text = re.sub(r"/\*.*?\*/", "", text, flags=re.DOTALL)
+    text = re.sub(r"//.*", "", text)
+    header_start = text.find("FoamFile")
+    if header_start >= 0:
+        header_end = text.index("}", header_start)
+        if re.search(r"\bformat\s+binary\s*;", text[header_start:header_end]):
+            raise ValueError(
+                f"{filepath} is in binary format. Only ascii meshes are supported."
+            )
+        text = text[header_end + 1:]
+    return re.findall(r"[(){};]|[^\s(){};]+", text)
+
+
+def _read_foam_list(filepath: Path) -> list[typing.Any]:
+    # Returns the top level list in a polyMesh file
+    # Nested lists, e.g. the points of a face, are returned as lists
+    # Size prefixes like the 4 in 4(0 1 2 3) are dropped
+    tokens = _read_foam_tokens(filepath)
+    stack: list[list[typing.Any]] = [[]]
+    for i, token in enumerate(tokens):
+        if token == "(":
+            stack.append([])
+        elif token == ")":
+            finished = stack.pop()
+            stack[-1].append(finished)
+        elif len(stack) == 1:
+            # Anything outside the list itself, e.g. the trailing semicolon
+            continue
+        elif i + 1 < len(tokens) and tokens[i + 1] == "(":
+            continue
+        else:
+            stack[-1].append(token)
+    return stack[0][0]
+
+
+@functools.lru_cache
+def read_cell_centres(case_dir: Path) -> npt.NDArray[np.float64]:
+    # Approximate each cell centre by the average of its face centres which is
+    # plenty for deciding whether a cell is inside a bounding box
+    mesh_dir = case_dir / "constant" / "polyMesh"
+    points = np.array(_read_foam_list(mesh_dir / "points"), dtype=np.float64)
+    faces = _read_foam_list(mesh_dir / "faces")
+    owner = np.array(_read_foam_list(mesh_dir / "owner"), dtype=np.int64)
+    neighbour = np.array(_read_foam_list(mesh_dir / "neighbour"), dtype=np.int64)
+    if len({len(face) for face in faces}) == 1:
+        face_centres = points[np.array(faces, dtype=np.int64)].mean(axis=1)
+    else:
+        face_centres = np.array([
+            points[np.array(face, dtype=np.int64)].mean(axis=0)
+            for face in faces
+            ])
+    num_cells = owner.max() + 1
+    if len(neighbour):
+        num_cells = max(num_cells, neighbour.max() + 1)
+    centres = np.zeros((num_cells, 3))
+    np.add.at(centres, owner, face_centres[:len(owner)])
+    np.add.at(centres, neighbour, face_centres[:len(neighbour)])
+    num_faces = (
+            np.bincount(owner, minlength=num_cells)
+            + np.bincount(neighbour, minlength=num_cells)
+            )
+    return centres / num_faces[:, np.newaxis]
+
+
+@functools.lru_cache
+def read_cell_zones(case_dir: Path) -> dict[str, npt.NDArray[np.int64]]:
+    tokens = _read_foam_tokens(case_dir / "constant" / "polyMesh" / "cellZones")
+    zones = {}
+    zone_name = None
+    i = 0
+    while i < len(tokens):
+        if tokens[i] == "{" and i > 0:
+            zone_name = tokens[i - 1]
+        elif tokens[i] == "cellLabels":
+            # cellLabels List<label> N ( ... ) ;
+            start = tokens.index("(", i)
+            end = tokens.index(")", start)
+            zones[zone_name] = np.array(tokens[start + 1:end], dtype=np.int64)
+            i = end
+        i += 1
+    return zones
+
+
+def _field_magnitude(values: typing.Any) -> typing.Any:
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim == 0:
+        return values
+    if values.ndim == 1 and values.shape == (3,):
+        # A uniform vector
+        return np.linalg.norm(values)
+    if values.ndim == 2:
+        return np.linalg.norm(values, axis=1)
+    return values
+
+
+def select_cells(
+        specs: list[str],
+        *,
+        case_dir: Path,
+        num_cells: int,
+        fields: typing.Callable[[str], typing.Any],
+        cells: typing.Optional[npt.NDArray[np.int64]] = None,
+        centres: typing.Optional[npt.NDArray[np.float64]] = None,
+        ) -> npt.NDArray[np.int64]:
+    # Returns the positions of the selected cells in the stored data
+    # The stored data covers every cell of the mesh if cells is None or only
+    # the cells (global indices) in cells if the data is already a subset
+    # fields is called with a field name and should return its stored values
+    # centres are the cell centres of the mesh (read from the mesh if None)
+    if cells is None:
+        global_cells = np.arange(num_cells)
+    else:
+        global_cells = np.asarray(cells)
+    mask = np.ones(len(global_cells), dtype=bool)
+    for spec in specs:
+        if spec.startswith("bbox:"):
+            bounds = [float(v) for v in spec[len("bbox:"):].split(",")]
+            if len(bounds) != 6:
+                raise ValueError(
+                    f"A bounding box needs 6 values xmin,ymin,zmin,xmax,ymax,zmax: {spec}"
+                )
+            if centres is None:
+                centres = read_cell_centres(case_dir)
+            cell_centres = centres[global_cells]
+            mask &= np.all(
+                    (cell_centres >= bounds[:3]) & (cell_centres <= bounds[3:]),
+                    axis=1,
+                    )
+        elif spec.startswith("zone:"):
+            zone_name = spec[len("zone:"):]
+            zones = read_cell_zones(case_dir)
+            if zone_name not in zones:
+                raise ValueError(
+                    f"Unknown cellZone {zone_name}. Available zones: {list(zones)}"
+                )
+            mask &= np.isin(global_cells, zones[zone_name])
+        elif match := THRESHOLD_PATTERN.match(spec):
+            compare = THRESHOLD_OPERATORS[match["op"]]
+            values = _field_magnitude(fields(match["field"]))
+            mask &= compare(values, float(match["value"]))
+        else:
+            raise ValueError(f"Unknown cell selection {spec}")
+    return np.flatnonzero(mask)
@@ -1,23 +1,29 @@
 #!/usr/bin/env python
-import pickle
 import argparse
 import textwrap
+import typing
 from pathlib import Path
 
 import cantera as ct
 import numpy as np
 from tqdm import tqdm
 
+from case_catalog import list_pickles
+from cell_selection import select_cells
+from pickle_io import load_pickle, write_pickle
+from pipeline import run_pipelined
+from rate_table import RateTable
 
-def _get_value(ofdata, var, index):
+
+def _get_values(ofdata, var, positions):
     try:
         iter(ofdata[var]["data"])
     except TypeError:
         # This is not iterable
         # It is probably a uniform value
-        return ofdata[var]["data"]
+        return np.full(len(positions), ofdata[var]["data"])
     else:
-        return ofdata[var]["data"][index]
+        return ofdata[var]["data"][positions]
 
 
 def _verify_OF_cantera_consistency(ofdata):
@@ -67,70 +73,135 @@ def _verify_OF_cantera_consistency(ofdata):
         )
 
 
-def _compute_rates(ofdata, num_cells):
+def _evaluate_state(state):
+    # state is [T, p, Y...] with Y in the order of the cantera species
+    # Returns [creation rates..., destruction rates..., heat release rate]
+    # Create a new solution object to be safe?
+    # This might not be required but I wonder how much it hurts
+    gas = ct.Solution("gri30.yaml")
+    gas.TPY = state[0], state[1], state[2:]
+    return np.concatenate([
+        gas.creation_rates,
+        gas.destruction_rates,
+        [gas.heat_release_rate],
+        ])
+
+
+def compute_rates(ofdata, num_cells, positions=None, rate_table=None):
+    # num_cells is the number of cells stored in ofdata
+    # If positions is given, only those cells are computed and the results are
+    # in the same order as positions
+    # If rate_table is given, repeated and nearby states are looked up in it
+    # instead of being evaluated again
     _verify_OF_cantera_consistency(ofdata)
     cantera_species = [sp.name for sp in ct.Solution("gri30.yaml").species()]
+    num_species = len(cantera_species)
+    if positions is None:
+        positions = np.arange(num_cells)
+    # One row of [T, p, Y...] per cell
+    states = np.column_stack([
+        _get_values(ofdata, var, positions)
+        for var in ["T", "p", *cantera_species]
+        ])
+    if rate_table is not None and len(states):
+        results = rate_table.evaluate(states, _evaluate_state)
+    else:
+        results = np.empty((len(states), 2 * num_species + 1))
+        for row, state in enumerate(tqdm(states)):
+            results[row] = _evaluate_state(state)
     computed_data = {}
-    # First create space for all the newly computed fields
-    for sp in cantera_species:
+    for i, sp in enumerate(cantera_species):
         computed_data[f"cr_{sp}_computed"] = {
             "type": "volScalarField",
             "dimensions": [0, 0, -1, 0, 0, 0, 0],
-            "data": [],
+            "data": results[:, i],
         }
         computed_data[f"dr_{sp}_computed"] = {
             "type": "volScalarField",
             "dimensions": [0, 0, -1, 0, 0, 0, 0],
-            "data": [],
-        }
-        computed_data["HRR_computed"] = {
-            "type": "volScalarField",
-            "dimensions": [1, -1, -3, 0, 0, 0, 0],
-            "data": [],
+            "data": results[:, num_species + i],
         }
-    for i in tqdm(range(num_cells)):
-        T = _get_value(ofdata, "T", i)
-        p = _get_value(ofdata, "p", i)
-        Y = np.array([_get_value(ofdata, sp, i) for sp in cantera_species])
-        # Create a new solution object to be safe?
-        # This might not be required but I wonder how much it hurts
-        gas = ct.Solution("gri30.yaml")
-        gas.TPY = T, p, Y
-        for i, sp in enumerate(cantera_species):
-            computed_data[f"cr_{sp}_computed"]["data"].append(
-                gas.creation_rates[i]
-            )
-            computed_data[f"dr_{sp}_computed"]["data"].append(
-                gas.destruction_rates[i]
-            )
-        computed_data["HRR_computed"]["data"].append(gas.heat_release_rate)
-    for i, sp in enumerate(cantera_species):
-        computed_data[f"cr_{sp}_computed"]["data"] = np.array(
-            computed_data[f"cr_{sp}_computed"]["data"]
-        )
-        computed_data[f"dr_{sp}_computed"]["data"] = np.array(
-            computed_data[f"dr_{sp}_computed"]["data"]
-        )
-        computed_data["HRR_computed"]["data"] = np.array(
-            computed_data["HRR_computed"]["data"]
-        )
+    computed_data["HRR_computed"] = {
+        "type": "volScalarField",
+        "dimensions": [1, -1, -3, 0, 0, 0, 0],
+        "data": results[:, 2 * num_species],
+    }
     return computed_data
 
 
+def select_positions(state_data, case_dir, cell_specs=None):
+    # Returns the number of cells stored in the state data and the positions of
+    # the selected cells in it (None if every stored cell is selected)
+    # The state data may already only hold a subset of the cells
+    state_cells = state_data.get('cells')
+    if state_cells is None:
+        num_stored_cells = state_data['num_cells']
+    else:
+        num_stored_cells = len(state_cells)
+    if cell_specs:
+        positions = select_cells(
+                cell_specs,
+                case_dir=case_dir,
+                num_cells=state_data['num_cells'],
+                fields=lambda var: state_data['data'][var]['data'],
+                cells=state_cells,
+                )
+    else:
+        positions = None
+    return num_stored_cells, positions
+
+
+def global_cells(state_data, positions):
+    # Map positions in the state data back to the cells of the mesh
+    state_cells = state_data.get('cells')
+    if positions is None:
+        return state_cells
+    elif state_cells is None:
+        return positions
+    else:
+        return state_cells[positions]
+
+
+def _compute_rate_solution(state_data, case_dir, cell_specs=None, rate_table=None):
+    num_stored_cells, positions = select_positions(
+            state_data,
+            case_dir,
+            cell_specs,
+            )
+    rate_data = compute_rates(
+            state_data['data'],
+            num_stored_cells,
+            positions,
+            rate_table,
+            )
+    if rate_table is not None:
+        print(rate_table.summary())
+    cells = global_cells(state_data, positions)
+    return {
+            'num_cells': state_data['num_cells'],
+            'cells': cells,
+            'data': rate_data,
+            }
+
+
 def compute_and_write_rate_data(
         *,
         state_data_pickle: Path,
         rate_data_pickle: Path,
         force: bool = False,
+        cell_specs: typing.Optional[list[str]] = None,
+        rate_table: typing.Optional[RateTable] = None,
         ) -> None:
     if rate_data_pickle.is_file() and not force:
         raise FileExistsError(f'{rate_data_pickle} already exists.')
-    with open(state_data_pickle, 'rb') as pfile:
-        state_data = pickle.load(pfile)
-    rate_data = _compute_rates(state_data['data'], state_data['num_cells'])
-    with open(rate_data_pickle, 'wb') as pfile:
-        # TODO: Do we need to include any metadata with the rate data?
-        pickle.dump({'data': rate_data}, pfile)
+    state_data = load_pickle(state_data_pickle)
+    rate_data = _compute_rate_solution(
+            state_data,
+            state_data_pickle.parent,
+            cell_specs,
+            rate_table,
+            )
+    write_pickle(rate_data_pickle, rate_data)
 
 
 def compute_and_write_all_rate_data(
@@ -139,12 +210,13 @@ def compute_and_write_all_rate_data(
         state_data_pickle_prefix: str,
         rate_data_pickle_prefix: str,
         force: bool = False,
+        cell_specs: typing.Optional[list[str]] = None,
+        queue_depth: int = 2,
+        rate_table: typing.Optional[RateTable] = None,
         ) -> None:
     # Create a list of the time directories that need to be processed
-    for state_data_pickle in tqdm(sorted(
-            case_dir.glob(f'{state_data_pickle_prefix}*.p'),
-            key=lambda p: float(p.stem.split('_')[-1]),
-            )):
+    work = []
+    for state_data_pickle in list_pickles(case_dir, state_data_pickle_prefix):
         rate_data_pickle = state_data_pickle.with_stem(
                 state_data_pickle.stem.replace(
                     state_data_pickle_prefix,
@@ -156,10 +228,21 @@ def compute_and_write_all_rate_data(
             continue
         if rate_data_pickle.is_file() and not force:
             continue
-        compute_and_write_rate_data(
-                state_data_pickle=state_data_pickle,
-                rate_data_pickle=rate_data_pickle,
-                )
+        work.append((state_data_pickle, rate_data_pickle))
+    # Load the next state and write the previous rates in the background while
+    # the chemistry is being evaluated
+    run_pipelined(
+            work,
+            load=lambda pickles: load_pickle(pickles[0]),
+            compute=lambda pickles, state_data: _compute_rate_solution(
+                state_data,
+                case_dir,
+                cell_specs,
+                rate_table,
+                ),
+            write=lambda pickles, rate_data: write_pickle(pickles[1], rate_data),
+            queue_depth=queue_depth,
+            )
 
 
 def main() -> None:
@@ -194,30 +277,122 @@ def main() -> None:
             help='overwrite rate pickle if it already exists',
             action='store_true',
             )
+    parser.add_argument(
+            '--cells',
+            action='append',
+            metavar='SPEC',
+            help=(
+                'only compute the selected cells: bbox:xmin,ymin,zmin,xmax,ymax,zmax, '
+                'zone:NAME or a threshold like T>1200 (repeat to intersect)'
+                ),
+            )
+    parser.add_argument(
+            '--prefetch',
+            type=int,
+            default=2,
+            help='number of times to read ahead and write behind when timestamp is "all" (0 to disable)',
+            )
+    parser.add_argument(
+            '-t',
+            '--table',
+            help='reuse rates of repeated and nearby states from this table file (created if missing)',
+            )
+    parser.add_argument(
+            '--table-tolerance',
+            type=float,
+            default=1e-4,
+            help='relative tolerance on T, p and every mass fraction above --table-mass-fraction-floor for reusing a state (0 for exact matches only)',
+            )
+    parser.add_argument(
+            '--table-mass-fraction-floor',
+            type=float,
+            default=1e-10,
+            help='mass fractions below this are treated as equal when comparing states',
+            )
+    parser.add_argument(
+            '--table-verify-fraction',
+            type=float,
+            default=0.01,
+            help=(
+                'fraction of reused states that are checked against a direct evaluation '
+                '(the check is statistical: unchecked reuses are only corrected if a check '
+                'in the same region fails later in the same time)'
+                ),
+            )
+    parser.add_argument(
+            '--table-error-tolerance',
+            type=float,
+            default=1e-2,
+            help='relative error of any rate above which a region of states is always evaluated directly',
+            )
+    parser.add_argument(
+            '--table-error-floor',
+            type=float,
+            default=1e-6,
+            help='added to the magnitude of every species rate (kmol/m^3/s) when computing the relative error',
+            )
+    parser.add_argument(
+            '--table-hrr-error-floor',
+            type=float,
+            default=1e6,
+            help=(
+                'added to the magnitude of the heat release rate (W/m^3) when computing the relative error '
+                '(the net heat release rate is a small difference of large terms near equilibrium)'
+                ),
+            )
 
     args = parser.parse_args()
 
-    if args.timestamp == "all":
-        compute_and_write_all_rate_data(
-                case_dir=args.case_dir,
-                state_data_pickle_prefix=args.solution_pickle_prefix,
-                rate_data_pickle_prefix=args.rate_pickle_prefix,
-                force=args.force,
+    if args.table:
+        table_filepath = args.case_dir / args.table
+        # The results are [creation rates..., destruction rates..., HRR]
+        num_species = ct.Solution("gri30.yaml").n_species
+        error_floor = np.append(
+                np.full(2 * num_species, args.table_error_floor),
+                args.table_hrr_error_floor,
                 )
-    else:
-        state_data_pickle = (
-                args.case_dir
-                / f'{args.solution_pickle_prefix}{args.timestamp}.p'
-                )
-        rate_data_pickle = (
-                args.case_dir / f'{args.rate_pickle_prefix}{args.timestamp}.p'
+        rate_table = RateTable.load(
+                table_filepath,
+                tolerance=args.table_tolerance,
+                verify_fraction=args.table_verify_fraction,
+                error_tolerance=args.table_error_tolerance,
+                mass_fraction_floor=args.table_mass_fraction_floor,
+                error_floor=error_floor,
                 )
+    else:
+        rate_table = None
 
-        compute_and_write_rate_data(
-                state_data_pickle=state_data_pickle,
-                rate_data_pickle=rate_data_pickle,
-                force=args.force,
-                )
+    try:
+        if args.timestamp == "all":
+            compute_and_write_all_rate_data(
+                    case_dir=args.case_dir,
+                    state_data_pickle_prefix=args.solution_pickle_prefix,
+                    rate_data_pickle_prefix=args.rate_pickle_prefix,
+                    force=args.force,
+                    cell_specs=args.cells,
+                    queue_depth=args.prefetch,
+                    rate_table=rate_table,
+                    )
+        else:
+            state_data_pickle = (
+                    args.case_dir
+                    / f'{args.solution_pickle_prefix}{args.timestamp}.p'
+                    )
+            rate_data_pickle = (
+                    args.case_dir / f'{args.rate_pickle_prefix}{args.timestamp}.p'
+                    )
+
+            compute_and_write_rate_data(
+                    state_data_pickle=state_data_pickle,
+                    rate_data_pickle=rate_data_pickle,
+                    force=args.force,
+                    cell_specs=args.cells,
+                    rate_table=rate_table,
+                    )
+    finally:
+        # Keep whatever was tabulated even if the run did not finish
+        if rate_table is not None:
+            rate_table.save(table_filepath)
 
 
 if __name__ == "__main__":
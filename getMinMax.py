@@ -3,8 +3,11 @@ import argparse
 import os
 import sys
 import collections
+from pathlib import Path
 from pprint import pprint
 
+from case_catalog import list_times
+
 # Check if a directory is specified
 # If it is, use it. Otherwise, use the 0/ directory
 if len(sys.argv) > 1:
@@ -39,12 +42,9 @@ if start_time > end_time:
 min_value = {}
 max_value = {}
 
-for t in sorted(os.listdir('.')):
-    try:
-        if float(t) < start_time or float(t) > end_time:
-            continue
-    except ValueError:
-        continue
+times = list_times(Path('.'), start_time, end_time)
+
+for t in times:
     current_min = None
     current_max = None
     with open(t + '/' + var, 'r') as infile:
@@ -0,0 +1,459 @@
+#!/usr/bin/env python
+import sys
+import argparse
+import typing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import numpy.typing as npt
+from tqdm import tqdm
+
+from case_catalog import list_pickles
+from cell_selection import read_cell_centres, select_cells
+from pickle_io import load_pickle, load_versioned_pickle, write_pickle
+from rwopenfoam import get_num_cells, list_time_dirs, read_variable
+
+# A cube is a directory with an index and one .npy file per field
+# Each file holds a (num_cells, capacity) array (with a trailing dimension of 3
+# for vector fields) so that the history of one cell is contiguous on disk
+# Only the first len(times) columns are filled and the rest is room for times
+# that are added later
+# Reading one time of a field touches every page of its file so the cube also
+# keeps a contiguous copy of the last time of each field (for thresholds) and
+# the cell centres (for point and bounding box queries)
+INDEX_FILENAME = "index.p"
+CENTRES_FILENAME = "centres.npy"
+CUBE_VERSION = 1
+
+# A source is (time, kind, path) where kind is "time_dir" or "pickle"
+Source = tuple[str, str, Path]
+
+
+def _field_filepath(cube_dir: Path, var: str) -> Path:
+    return cube_dir / f"{var}.npy"
+
+
+def _last_filepath(cube_dir: Path, var: str) -> Path:
+    return cube_dir / f"last_{var}.npy"
+
+
+def _save_atomically(filepath: Path, values: npt.NDArray[typing.Any]) -> None:
+    tmp_filepath = filepath.with_name(f".{filepath.name}.tmp")
+    with open(tmp_filepath, "wb") as outfile:
+        np.save(outfile, values)
+    tmp_filepath.replace(filepath)
+
+
+def _read_index(cube_dir: Path) -> dict[str, typing.Any]:
+    return load_versioned_pickle(cube_dir / INDEX_FILENAME, CUBE_VERSION)
+
+
+def _write_index(cube_dir: Path, index: dict[str, typing.Any]) -> None:
+    write_pickle(cube_dir / INDEX_FILENAME, index)
+
+
+def _load_fields(
+        source: Source,
+        fields: list[str],
+        num_cells: int,
+        ) -> dict[str, typing.Any]:
+    # Returns the values of every cell of the mesh for each field
+    # Cells that are not in a subset pickle are NaN
+    _, kind, path = source
+    values = {}
+    if kind == "time_dir":
+        for var in fields:
+            var_file = path / var
+            if not var_file.is_file() and var.startswith("Y_"):
+                var_file = path / var[len("Y_"):]
+            values[var] = read_variable(var_file, num_cells)["data"]
+        return values
+    solution = load_pickle(path)
+    cells = solution.get("cells")
+    for var in fields:
+        data = solution["data"][var]["data"]
+        if cells is not None and isinstance(data, np.ndarray):
+            full_data = np.full((num_cells, *data.shape[1:]), np.nan)
+            full_data[cells] = data
+            data = full_data
+        values[var] = data
+    return values
+
+
+def _num_components(values: typing.Any) -> int:
+    # Vector fields are (num_cells, 3) arrays or uniform 3-tuples
+    if isinstance(values, tuple):
+        return len(values)
+    if np.ndim(values) == 2:
+        return np.shape(values)[1]
+    return 1
+
+
+def _times_per_block(
+        index: dict[str, typing.Any],
+        num_cells: int,
+        block_memory: int,
+        ) -> int:
+    # How many loaded times fit in block_memory bytes
+    values_per_cell = sum(info["components"] for info in index["fields"].values())
+    return max(1, block_memory // (8 * num_cells * values_per_cell))
+
+
+def _write_block(
+        cube_dir: Path,
+        first_column: int,
+        loaded: list[dict[str, typing.Any]],
+        fields: list[str],
+        num_cells: int,
+        ) -> None:
+    # Every row of the cube holds all the times of a cell so writing a column
+    # dirties every page of the file
+    # Write all the times of a block together in contiguous chunks of rows so
+    # that each page is written once per block instead of once per time
+    for var in fields:
+        cube = np.load(_field_filepath(cube_dir, var), mmap_mode="r+")
+        rows_per_chunk = max(1, 2**24 // max(1, len(loaded) * cube[0, 0].size))
+        for start in range(0, num_cells, rows_per_chunk):
+            stop = min(start + rows_per_chunk, num_cells)
+            chunk = np.empty((stop - start, len(loaded), *cube.shape[2:]))
+            for i, values in enumerate(loaded):
+                value = values[var]
+                # Uniform values are broadcast to every cell
+                chunk[:, i] = value[start:stop] if isinstance(value, np.ndarray) else value
+            cube[start:stop, first_column:first_column + len(loaded)] = chunk
+        cube.flush()
+        del cube
+
+
+def _allocate(
+        cube_dir: Path,
+        var: str,
+        num_cells: int,
+        capacity: int,
+        num_components: int,
+        num_filled: int,
+        ) -> None:
+    # Create the file for a field or grow an existing one to capacity
+    shape: tuple[int, ...] = (num_cells, capacity)
+    if num_components > 1:
+        shape = (*shape, num_components)
+    filepath = _field_filepath(cube_dir, var)
+    tmp_filepath = filepath.with_name(f".{filepath.name}.tmp")
+    cube = np.lib.format.open_memmap(
+            tmp_filepath, mode="w+", dtype=np.float64, shape=shape,
+            )
+    cube[:] = np.nan
+    if num_filled and filepath.is_file():
+        old_cube = np.load(filepath, mmap_mode="r")
+        # Copy in blocks of cells to keep the memory use bounded
+        block_size = max(1, 2**24 // max(1, old_cube[0].size))
+        for start in range(0, num_cells, block_size):
+            stop = min(start + block_size, num_cells)
+            cube[start:stop, :num_filled] = old_cube[start:stop, :num_filled]
+        del old_cube
+    cube.flush()
+    del cube
+    tmp_filepath.replace(filepath)
+
+
+def build_cube(
+        cube_dir: Path,
+        sources: list[Source],
+        fields: list[str],
+        num_cells: int,
+        num_workers: int = 4,
+        block_memory: int = 2**31,
+        case_dir: typing.Optional[Path] = None,
+        ) -> None:
+    # Create a cube or add the times in sources that are newer than the last
+    # time in the cube
+    # The cell centres are stored with the cube if the mesh of case_dir can
+    # be read
+    if (cube_dir / INDEX_FILENAME).is_file():
+        index = _read_index(cube_dir)
+        if set(fields) != set(index["fields"]):
+            raise ValueError(
+                f"{cube_dir} holds the fields {list(index['fields'])}, "
+                f"not {fields}. Use a new cube for different fields."
+            )
+        if num_cells != index["num_cells"]:
+            raise ValueError(
+                f"{cube_dir} has {index['num_cells']} cells, not {num_cells}"
+            )
+    else:
+        cube_dir.mkdir(parents=True, exist_ok=True)
+        index = {
+                "version": CUBE_VERSION,
+                "num_cells": num_cells,
+                "times": [],
+                "capacity": 0,
+                "fields": {},
+                }
+    existing_times = set(index["times"])
+    sources = [s for s in sources if s[0] not in existing_times]
+    if not sources:
+        return
+    if index["times"] and float(sources[0][0]) < float(index["times"][-1]):
+        raise ValueError(
+            f"Cannot add time {sources[0][0]} before the last time "
+            f"{index['times'][-1]} in {cube_dir}. Rebuild the cube instead."
+        )
+    if not index["fields"]:
+        # Figure out which fields are vectors from the first time
+        first_values = _load_fields(sources[0], fields, num_cells)
+        for var, values in first_values.items():
+            index["fields"][var] = {"components": _num_components(values)}
+    num_filled = len(index["times"])
+    needed = num_filled + len(sources)
+    if needed > index["capacity"]:
+        # Leave room so that adding a few times later does not mean rewriting
+        # the whole cube every time
+        capacity = max(needed, 2 * index["capacity"], 16)
+        for var, info in index["fields"].items():
+            _allocate(
+                    cube_dir, var, num_cells, capacity,
+                    info["components"], num_filled,
+                    )
+        index["capacity"] = capacity
+        _write_index(cube_dir, index)
+    # The times of a block are loaded in parallel and written together
+    times_per_block = _times_per_block(index, num_cells, block_memory)
+    with ProcessPoolExecutor(max_workers=num_workers) as executor, \
+            tqdm(total=len(sources)) as progress:
+        for start in range(0, len(sources), times_per_block):
+            block = sources[start:start + times_per_block]
+            loaded = []
+            for values in executor.map(
+                    _load_fields,
+                    block,
+                    [fields] * len(block),
+                    [num_cells] * len(block),
+                    ):
+                loaded.append(values)
+                progress.update()
+            _write_block(cube_dir, num_filled + start, loaded, fields, num_cells)
+    for var in fields:
+        components = index["fields"][var]["components"]
+        values = np.empty((num_cells, components) if components > 1 else num_cells)
+        # Uniform values are broadcast to every cell
+        values[:] = loaded[-1][var]
+        _save_atomically(_last_filepath(cube_dir, var), values)
+    if case_dir is not None and not (cube_dir / CENTRES_FILENAME).is_file():
+        try:
+            centres = read_cell_centres(case_dir)
+        except FileNotFoundError:
+            centres = None
+        if centres is not None and len(centres) == num_cells:
+            _save_atomically(cube_dir / CENTRES_FILENAME, centres)
+    index["times"].extend(s[0] for s in sources)
+    _write_index(cube_dir, index)
+
+
+def open_cube(cube_dir: Path) -> tuple[list[str], dict[str, npt.NDArray[np.float64]]]:
+    # Returns the times and a read only memory map of each field limited to the
+    # filled times
+    index = _read_index(cube_dir)
+    num_times = len(index["times"])
+    cubes = {
+            var: np.load(_field_filepath(cube_dir, var), mmap_mode="r")[:, :num_times]
+            for var in index["fields"]
+            }
+    return index["times"], cubes
+
+
+def last_values(cube_dir: Path, var: str) -> npt.NDArray[np.float64]:
+    # The values of a field at the last time in the cube
+    index = _read_index(cube_dir)
+    if var not in index["fields"]:
+        raise ValueError(
+            f"{var} is not in {cube_dir}. Available fields: {list(index['fields'])}"
+        )
+    if _last_filepath(cube_dir, var).is_file():
+        return np.load(_last_filepath(cube_dir, var))
+    # Cubes built before the last time was kept separately
+    num_times = len(index["times"])
+    return np.array(np.load(_field_filepath(cube_dir, var), mmap_mode="r")[:, num_times - 1])
+
+
+def cell_centres(cube_dir: Path, case_dir: Path) -> npt.NDArray[np.float64]:
+    # The cell centres stored with the cube or read from the mesh of case_dir
+    if (cube_dir / CENTRES_FILENAME).is_file():
+        return np.load(cube_dir / CENTRES_FILENAME)
+    return read_cell_centres(case_dir)
+
+
+def pickle_sources(case_dir: Path, pickle_filepath_prefix: str) -> list[Source]:
+    return [
+            (p.stem[len(pickle_filepath_prefix):], "pickle", p)
+            for p in list_pickles(case_dir, pickle_filepath_prefix)
+            ]
+
+
+def time_dir_sources(case_dir: Path) -> list[Source]:
+    return [(p.name, "time_dir", p) for p in list_time_dirs(case_dir)]
+
+
+def _write_history(
+        outfile: typing.TextIO,
+        times: list[str],
+        cells: npt.NDArray[np.int64],
+        history: npt.NDArray[np.float64],
+        ) -> None:
+    # One row per time and one column per cell (and component)
+    if history.ndim == 3:
+        header = [
+                f"{cell}_{component}"
+                for cell in cells for component in "xyz"
+                ]
+        history = history.transpose(1, 0, 2).reshape(len(times), -1)
+    else:
+        header = [str(cell) for cell in cells]
+        history = history.T
+    outfile.write(",".join(["time", *header]) + "\n")
+    for time, row in zip(times, history):
+        outfile.write(",".join([time, *(repr(float(v)) for v in row)]) + "\n")
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(
+            prog='history_cube',
+            description='Build and query a cells x times cube of field values',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            )
+    parser.add_argument(
+            '--case-dir',
+            type=Path,
+            default=Path('.'),
+            help='the OpenFOAM case directory',
+            )
+    subparsers = parser.add_subparsers(title='subcommands', dest='command')
+
+    parser_build = subparsers.add_parser(
+            'build',
+            help='Create a cube or add new times to it',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            )
+    parser_build.add_argument('cube', help='the cube directory')
+    parser_build.add_argument(
+            'fields',
+            help='comma separated list of fields to include, e.g. T,p,U',
+            )
+    parser_build.add_argument(
+            '-p',
+            '--from-pickles',
+            metavar='PREFIX',
+            help='read the times from pickles instead of the time directories',
+            )
+    parser_build.add_argument(
+            '-j',
+            '--jobs',
+            type=int,
+            default=4,
+            help='number of processes to build with',
+            )
+    parser_build.add_argument(
+            '-m',
+            '--block-memory',
+            type=int,
+            default=2048,
+            help='memory in MB for the block of times that is loaded before it is written',
+            )
+
+    parser_query = subparsers.add_parser(
+            'query',
+            help='Print the history of some cells as CSV',
+            )
+    parser_query.add_argument('cube', help='the cube directory')
+    parser_query.add_argument('field', help='the field to print')
+    selection = parser_query.add_mutually_exclusive_group(required=True)
+    selection.add_argument(
+            '--point',
+            type=float,
+            nargs=3,
+            metavar=('X', 'Y', 'Z'),
+            help='the cell whose centre is closest to this point',
+            )
+    selection.add_argument(
+            '--cell-list',
+            help='comma separated list of cell indices',
+            )
+    selection.add_argument(
+            '--region',
+            action='append',
+            metavar='SPEC',
+            help=(
+                'bbox:xmin,ymin,zmin,xmax,ymax,zmax, zone:NAME or a threshold '
+                'like T>1200 evaluated at the last time (repeat to intersect)'
+                ),
+            )
+    parser_query.add_argument(
+            '-o',
+            '--output',
+            type=Path,
+            help='write to this file instead of stdout (.npy writes the raw array)',
+            )
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        cube_dir = args.case_dir / args.cube
+        fields = args.fields.split(",")
+        if args.from_pickles:
+            sources = pickle_sources(args.case_dir, args.from_pickles)
+            num_cells = load_pickle(sources[0][2])["num_cells"]
+        else:
+            sources = time_dir_sources(args.case_dir)
+            num_cells = get_num_cells()
+        build_cube(
+                cube_dir,
+                sources,
+                fields,
+                num_cells,
+                num_workers=args.jobs,
+                block_memory=args.block_memory * 2**20,
+                case_dir=args.case_dir,
+                )
+    elif args.command == 'query':
+        cube_dir = args.case_dir / args.cube
+        times, cubes = open_cube(cube_dir)
+        if args.field not in cubes:
+            raise ValueError(
+                f"{args.field} is not in {cube_dir}. Available fields: {list(cubes)}"
+            )
+        if args.point:
+            centres = cell_centres(cube_dir, args.case_dir)
+            distances = np.linalg.norm(centres - np.array(args.point), axis=1)
+            cells = np.array([np.argmin(distances)])
+        elif args.cell_list:
+            cells = np.array([int(c) for c in args.cell_list.split(",")])
+        else:
+            cells = select_cells(
+                    args.region,
+                    case_dir=args.case_dir,
+                    num_cells=cubes[args.field].shape[0],
+                    fields=lambda var: last_values(cube_dir, var),
+                    centres=(
+                        cell_centres(cube_dir, args.case_dir)
+                        if any(spec.startswith("bbox:") for spec in args.region)
+                        else None
+                        ),
+                    )
+        # Fancy indexing the rows of the memory map only reads those rows
+        history = np.asarray(cubes[args.field][cells])
+        if args.output and args.output.suffix == ".npy":
+            np.save(args.output, history)
+        elif args.output:
+            with open(args.output, "w") as outfile:
+                _write_history(outfile, times, cells, history)
+        else:
+            _write_history(sys.stdout, times, cells, history)
+    elif args.command is None:
+        parser.print_usage()
+    else:
+        raise ValueError(f'Unknown command {args.command}')
+
+
+if __name__ == "__main__":
+    main()
@@ -48,19 +48,31 @@ done
 [ -z $NPROCS ] && echo "Number of processors not specified." && echo "$USAGE" && exit 1
 
 APPNAME="reconstructPar"
+SCRIPTDIR=$(dirname "$(readlink -f "$0")")
 
 # Figure out what times are available
-tLowReconstructed=$(ls -d [0-9]* | sort -g | head -1)
-tHighReconstructed=$(ls -d [0-9]* | sort -gr | head -1)
-tLowDecomposed=$(ls processor0 -1v | sed '/constant/d' | sort -g | head -1)
-tHighDecomposed=$(ls processor0 -1v | sed '/constant/d' | sort -gr | head -1)
+# The case catalog keeps the sorted times so that large cases are not listed again every time
+mapfile -t reconstructedTimes < <(python3 "$SCRIPTDIR/case_catalog.py" times)
+mapfile -t decomposedTimes < <(python3 "$SCRIPTDIR/case_catalog.py" times --decomposed)
+[ ${#decomposedTimes[@]} -eq 0 ] && echo "No decomposed times in processor0." && exit 1
+tLowReconstructed=${reconstructedTimes[0]}
+tHighReconstructed=${reconstructedTimes[@]: -1}
+[ -z "$tHighReconstructed" ] && tHighReconstructed=-1
+tLowDecomposed=${decomposedTimes[0]}
+tHighDecomposed=${decomposedTimes[@]: -1}
+
+# Print the nth (starting from 1) decomposed time or nothing if there is no such time
+decomposedTime() {
+  [ "$1" -ge 1 ] && echo "${decomposedTimes[$(( $1 - 1 ))]}"
+  return 0
+}
 
 # Now figure out what times should be reconstructed
 
 # Start by assuming that we're going to reconstruct all times in the decomposed directories and then adjust from there
 tLow=$tLowDecomposed
 tHigh=$tHighDecomposed
-nTimes=$(ls -d processor0/[0-9]*/ | wc -l)
+nTimes=${#decomposedTimes[@]}
 nLow=1
 nHigh=$nTimes
 
@@ -86,12 +98,12 @@ if [ -n $tLowUser ] || [ -n $tHighUser ]; then
   # Now adjust the values until the user specs are satisfied
   while [ $(echo "$tLow < $tLowUser" | bc) == 1 ]; do
     let nLow=$nLow+1
-    tLow=$(ls processor0 -1v | sed '/constant/d' | sort -g | sed -n "$nLow"p)
+    tLow=$(decomposedTime $nLow)
     [ -z "$tLow" ] && echo "Unfortunate error because tLow became too high." && exit 5
   done
   while [ $(echo "$tHigh > $tHighUser" | bc) == 1 ]; do
     let nHigh=$nHigh-1
-    tHigh=$(ls processor0 -1v | sed '/constant/d' | sort -g | sed -n "$nHigh"p)
+    tHigh=$(decomposedTime $nHigh)
     [ -z "$tHigh" ] && echo "Unfortunate error because tHigh became too small." && exit 5
   done
 fi
@@ -101,7 +113,7 @@ fi
 if ! [ "$FORCE" == "yes" ]; then
   while [ $(echo "$tLow <= $tHighReconstructed" | bc) == 1 ]; do
     let nLow=$nLow+1
-    tLow=$(ls processor0 -1v | sed '/constant/d' | sort -g | sed -n "$nLow"p)
+    tLow=$(decomposedTime $nLow)
     [ -z "$tLow" ] && echo "Unfortunate error because tLow became too high." && exit 5
   done
 fi
@@ -153,7 +165,7 @@ for i in $(seq $NPROCS); do
   else
     nHighProc=$(( $nLowProc + $timesPerProc - 1 ))
   fi
-  tHighProc=$(ls processor0 -1v | sed '/constant/d' | sort -g | sed -n "$nHighProc"p)
+  tHighProc=$(decomposedTime $nHighProc)
   echo "Starting job $i: from $tLowProc to $tHighProc"
   if [ -n "$FIELDS" ]; then
     $($APPNAME -fields "($FIELDS)" -time $tLowProc:$tHighProc > $TEMPDIR/output-$i &)
@@ -162,14 +174,15 @@ for i in $(seq $NPROCS); do
   fi
   PIDS="$PIDS $(pgrep -n -x $APPNAME)"  # Get the PID of the latest (-n) job exactly matching (-x) $APPNAME
   nLowProc=$(( $nHighProc + 1 ))
-  tLowProc=$(ls processor0 -1v | sed '/constant/d' | sort -g | sed -n "$nLowProc"p)
+  tLowProc=$(decomposedTime $nLowProc)
 done
 
 echo "PIDS: $PIDS"
 
 # Sleep until jobs finish and provide progress
 until [ $(ps -p $PIDS | wc -l) -eq 1 ]; do
-  nTimeDirsCreated=$(ls -d [0-9]* | sort -g | sed -n "/$tLow/,/$tHigh/p" | wc -l)
+  # One listing of the case directory is much cheaper than a catalog refresh every second
+  nTimeDirsCreated=$(ls -d [0-9]*/ | awk -v lo="$tLow" -v hi="$tHigh" '$1 + 0 >= lo + 0 && $1 + 0 <= hi + 0' | wc -l)
   # Update the last line with the current status so as to not flood the terminal
   # The \033[K escape sequence clears the line before writing
   # Taken from https://stackoverflow.com/questions/2388090/how-to-delete-and-replace-last-line-in-the-terminal-using-bash
@@ -0,0 +1,28 @@
+import pickle
+import typing
+from pathlib import Path
+
+
+def load_pickle(filepath: Path) -> typing.Any:
+    with open(filepath, "rb") as pfile:
+        return pickle.load(pfile)
+
+
+def write_pickle(filepath: Path, obj: typing.Any) -> None:
+    # Write to a temporary file first so that an interrupted write never
+    # leaves a truncated pickle behind that looks complete
+    tmp_filepath = filepath.with_name(f".{filepath.name}.tmp")
+    with open(tmp_filepath, "wb") as pfile:
+        pickle.dump(obj, pfile)
+    tmp_filepath.replace(filepath)
+
+
+def load_versioned_pickle(filepath: Path, version: int) -> dict[str, typing.Any]:
+    # Load a dictionary that records the version of the format it was written in
+    obj = load_pickle(filepath)
+    if obj["version"] != version:
+        raise ValueError(
+            f"{filepath} has version {obj['version']} "
+            f"but version {version} is required"
+        )
+    return obj
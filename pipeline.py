@@ -0,0 +1,147 @@
+import queue
+import threading
+import time
+import typing
+
+from tqdm import tqdm
+
+# Marks the end of the items in a queue
+_DONE = object()
+
+
+class _Stopped(Exception):
+    pass
+
+
+def _put(q: queue.Queue, item: typing.Any, stop: threading.Event) -> None:
+    # Block while the queue is full but give up if another stage has failed so
+    # that nothing waits forever on a queue that is no longer being drained
+    while True:
+        if stop.is_set():
+            raise _Stopped()
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+def _get(q: queue.Queue, stop: threading.Event) -> typing.Any:
+    while True:
+        if stop.is_set():
+            raise _Stopped()
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+
+
+def run_pipelined(
+        items: list[typing.Any],
+        *,
+        load: typing.Callable[[typing.Any], typing.Any],
+        compute: typing.Callable[[typing.Any, typing.Any], typing.Any],
+        write: typing.Callable[[typing.Any, typing.Any], None],
+        queue_depth: int = 2,
+        ) -> dict[str, float]:
+    # Run load(item), compute(item, loaded) and write(item, computed) for every
+    # item
+    # A loader thread reads ahead and a writer thread writes behind while the
+    # calling thread computes so that the I/O overlaps with the computation
+    # At most queue_depth loaded items and queue_depth computed items are held
+    # in memory at any time
+    # A queue_depth of 0 runs everything one after the other in this thread
+    # Returns the time spent in each stage and how much of the I/O was hidden
+    timings = {"load": 0.0, "compute": 0.0, "write": 0.0}
+    start_time = time.perf_counter()
+
+    def timed(stage: str, func: typing.Callable, *args: typing.Any) -> typing.Any:
+        stage_start = time.perf_counter()
+        result = func(*args)
+        timings[stage] += time.perf_counter() - stage_start
+        return result
+
+    if queue_depth <= 0:
+        for item in tqdm(items):
+            loaded = timed("load", load, item)
+            computed = timed("compute", compute, item, loaded)
+            timed("write", write, item, computed)
+        return _summarize(timings, time.perf_counter() - start_time)
+
+    loaded_queue: queue.Queue = queue.Queue(maxsize=queue_depth)
+    computed_queue: queue.Queue = queue.Queue(maxsize=queue_depth)
+    stop = threading.Event()
+    errors: list[BaseException] = []
+
+    def loader() -> None:
+        try:
+            for item in items:
+                _put(loaded_queue, (item, timed("load", load, item)), stop)
+            _put(loaded_queue, _DONE, stop)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    def writer() -> None:
+        try:
+            while (entry := _get(computed_queue, stop)) is not _DONE:
+                timed("write", write, *entry)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    loader_thread = threading.Thread(target=loader, daemon=True)
+    writer_thread = threading.Thread(target=writer, daemon=True)
+    loader_thread.start()
+    writer_thread.start()
+    try:
+        with tqdm(total=len(items)) as progress:
+            while (entry := _get(loaded_queue, stop)) is not _DONE:
+                item, loaded = entry
+                computed = timed("compute", compute, item, loaded)
+                # Drop the reference so the loaded data can be freed while the
+                # result waits to be written
+                del entry, loaded
+                _put(computed_queue, (item, computed), stop)
+                progress.update()
+            _put(computed_queue, _DONE, stop)
+        writer_thread.join()
+    except _Stopped:
+        pass
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        loader_thread.join()
+        writer_thread.join()
+    if errors:
+        raise errors[0]
+    return _summarize(timings, time.perf_counter() - start_time)
+
+
+def _summarize(timings: dict[str, float], wall_time: float) -> dict[str, float]:
+    io_time = timings["load"] + timings["write"]
+    total_time = io_time + timings["compute"]
+    hidden_time = min(max(total_time - wall_time, 0.0), io_time)
+    stats = {
+            **timings,
+            "wall": wall_time,
+            "io": io_time,
+            "hidden_io": hidden_time,
+            }
+    hidden_fraction = hidden_time / io_time if io_time > 0 else 0.0
+    print(
+        f"Load: {timings['load']:.1f} s, "
+        f"compute: {timings['compute']:.1f} s, "
+        f"write: {timings['write']:.1f} s, "
+        f"wall: {wall_time:.1f} s"
+    )
+    print(
+        f"Hid {hidden_time:.1f} s of {io_time:.1f} s of I/O "
+        f"({100 * hidden_fraction:.0f}%)"
+    )
+    return stats
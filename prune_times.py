@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+import argparse
+import shutil
+from fnmatch import fnmatchcase
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from decimal import Decimal, InvalidOperation
+from pathlib import Path
+
+from tqdm import tqdm
+
+from case_catalog import CaseCatalog, CaseScan, query_case
+
+
+def _to_time(name: str) -> Decimal | None:
+    # Use Decimal instead of float so that checks like "is this a multiple of
+    # the write interval" are exact for names like 0.0003
+    try:
+        time = Decimal(name)
+    except InvalidOperation:
+        return None
+    if not time.is_finite():
+        return None
+    return time
+
+
+def _positive_interval(value: str) -> Decimal:
+    interval = _to_time(value)
+    if interval is None or interval <= 0:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive interval")
+    return interval
+
+
+def _non_negative_int(value: str) -> int:
+    try:
+        number = int(value)
+    except ValueError:
+        number = -1
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"{value} is not a non-negative integer")
+    return number
+
+
+def archived_time_ranges(catalog: CaseCatalog | CaseScan) -> list[tuple[Decimal, Decimal]]:
+    ranges = []
+    for _, first_name, last_name in catalog.archives():
+        first = _to_time(first_name)
+        last = _to_time(last_name)
+        if first is None or last is None:
+            continue
+        ranges.append((first, last))
+    return ranges
+
+
+def select_times_to_keep(
+        times: list[str],
+        *,
+        keep_every: Decimal | None = None,
+        keep_last: int = 1,
+        keep_first: bool = True,
+        reconstructed_times: set[str] | None = None,
+        archived_ranges: list[tuple[Decimal, Decimal]] | None = None,
+        only_matching: list[str] | None = None,
+        ) -> set[str]:
+    # Each rule adds times to the set that is kept
+    # A time is deleted only if no rule asks for it to be kept
+    # The first time (usually the initial conditions) is kept unless
+    # keep_first is False
+    # If only_matching is given, times whose names do not match any of its
+    # glob patterns are always kept
+    if keep_every is not None and keep_every <= 0:
+        raise ValueError(f"keep_every must be positive, not {keep_every}")
+    if keep_last < 0:
+        raise ValueError(f"keep_last must not be negative, not {keep_last}")
+    keep = set()
+    sorted_times = sorted(times, key=_to_time)
+    if keep_first:
+        keep.update(sorted_times[:1])
+    if keep_last > 0:
+        keep.update(sorted_times[-keep_last:])
+    for t in sorted_times:
+        time = _to_time(t)
+        if only_matching is not None and not any(
+                fnmatchcase(t, pattern) for pattern in only_matching
+                ):
+            keep.add(t)
+        elif keep_every is not None and time % keep_every == 0:
+            keep.add(t)
+        elif reconstructed_times is not None and t in reconstructed_times:
+            keep.add(t)
+        elif archived_ranges and any(
+                first <= time <= last for first, last in archived_ranges
+                ):
+            keep.add(t)
+    return keep
+
+
+def prune_decomposed_times(
+        case_dir: Path,
+        *,
+        keep_every: Decimal | None = None,
+        keep_last: int = 1,
+        keep_first: bool = True,
+        keep_reconstructed: bool = False,
+        keep_archived: bool = False,
+        only_matching: list[str] | None = None,
+        num_workers: int = 8,
+        dry_run: bool = False,
+        ) -> list[Path]:
+    # The catalog only lists the processor directories that changed since it
+    # was last used
+    def query(catalog: CaseCatalog | CaseScan) -> tuple:
+        return (
+                catalog.processor_times(),
+                set(catalog.times()) if keep_reconstructed else None,
+                archived_time_ranges(catalog) if keep_archived else None,
+                )
+    times_by_processor, reconstructed_times, archived_ranges = query_case(
+            case_dir, query, num_workers=num_workers,
+            )
+    processor_times = {
+            case_dir / processor: times
+            for processor, times in times_by_processor.items()
+            }
+    if not processor_times:
+        raise FileNotFoundError(f"No processor directories in {case_dir}")
+    # Decide what to keep based on every time that exists in any processor
+    # directory so that a time which was only partially written by a job that
+    # died is still treated as the latest time
+    all_times = set()
+    for times in processor_times.values():
+        all_times.update(times)
+    keep = select_times_to_keep(
+            list(all_times),
+            keep_every=keep_every,
+            keep_last=keep_last,
+            keep_first=keep_first,
+            reconstructed_times=reconstructed_times,
+            archived_ranges=archived_ranges,
+            only_matching=only_matching,
+            )
+    to_delete = [
+            processor_dir / t
+            for processor_dir, times in processor_times.items()
+            for t in times
+            if t not in keep
+            ]
+    print(
+        f"Keeping {len(keep)} / {len(all_times)} times "
+        f"in {len(processor_times)} processor directories"
+        )
+    print(f"Deleting {len(to_delete)} directories")
+    if dry_run:
+        for path in to_delete:
+            print(f"Would delete {path}")
+        return to_delete
+    # Nothing is renamed out of the way so an interrupted run just leaves some
+    # of the unwanted times behind for the next run to pick up
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(shutil.rmtree, p) for p in to_delete]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            future.result()
+    return to_delete
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(
+            prog='prune_times',
+            description='Delete decomposed time directories that are not kept by any retention rule',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            )
+    parser.add_argument(
+            '--case-dir',
+            type=Path,
+            default=Path('.'),
+            help='the OpenFOAM case directory',
+            )
+    parser.add_argument(
+            '-e',
+            '--keep-every',
+            type=_positive_interval,
+            help='keep times that are a multiple of this interval',
+            )
+    parser.add_argument(
+            '-l',
+            '--keep-last',
+            type=_non_negative_int,
+            default=1,
+            help='keep the last N times',
+            )
+    parser.add_argument(
+            '--delete-first',
+            help='allow the first time (usually the initial conditions) to be deleted',
+            action='store_true',
+            )
+    parser.add_argument(
+            '-r',
+            '--keep-reconstructed',
+            help='keep times that have already been reconstructed',
+            action='store_true',
+            )
+    parser.add_argument(
+            '-a',
+            '--keep-archived',
+            help='keep times that are covered by a times_<first>_<last>.tgz archive',
+            action='store_true',
+            )
+    parser.add_argument(
+            '-m',
+            '--only-matching',
+            action='append',
+            metavar='PATTERN',
+            help='only delete times whose names match this glob pattern (can be given more than once)',
+            )
+    parser.add_argument(
+            '-j',
+            '--jobs',
+            type=int,
+            default=8,
+            help='number of directories to delete simultaneously',
+            )
+    parser.add_argument(
+            '-n',
+            '--dry-run',
+            help='only print what would be deleted',
+            action='store_true',
+            )
+
+    args = parser.parse_args()
+
+    prune_decomposed_times(
+            args.case_dir,
+            keep_every=args.keep_every,
+            keep_last=args.keep_last,
+            keep_first=not args.delete_first,
+            keep_reconstructed=args.keep_reconstructed,
+            keep_archived=args.keep_archived,
+            only_matching=args.only_matching,
+            num_workers=args.jobs,
+            dry_run=args.dry_run,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+import typing
+from pathlib import Path
+
+import numpy as np
+import numpy.typing as npt
+from tqdm import tqdm
+
+from pickle_io import load_versioned_pickle, write_pickle
+
+TABLE_VERSION = 3
+
+
+class RateTable:
+    # Tabulates the results of an expensive function of the thermochemical
+    # state [T, p, Y...] so that repeated and nearby states are not evaluated
+    # again
+    #
+    # States are compared using log(T), log(p) and log(Y + mass_fraction_floor)
+    # so the tolerance is a relative tolerance on T, p and every mass fraction
+    # that is well above the floor (minor species like radicals included)
+    # States that fall in the same box of that size reuse the nearest tabulated
+    # result
+    # The first reuse in every box and a random fraction of the rest are
+    # checked against a direct evaluation
+    # The error of a check is the largest relative error of any component
+    # (with error_floor added to the magnitude of each one)
+    # error_floor may be an array with a floor for each component when they
+    # have different units
+    # If it exceeds error_tolerance, every state in that box is evaluated
+    # directly from then on and the states of the current call that reused a
+    # result from that box are evaluated again
+    # The check is statistical: results returned by earlier calls are not
+    # revisited when a box fails later
+    # A tolerance of 0 only reuses exactly repeated states
+
+    def __init__(
+            self,
+            tolerance: float = 1e-4,
+            verify_fraction: float = 0.01,
+            error_tolerance: float = 1e-2,
+            max_entries: int = 500_000,
+            seed: typing.Optional[int] = None,
+            mass_fraction_floor: float = 1e-10,
+            error_floor: float | npt.NDArray[np.float64] = 1e-6,
+            ):
+        self.tolerance = tolerance
+        self.verify_fraction = verify_fraction
+        self.error_tolerance = error_tolerance
+        self.max_entries = max_entries
+        self.mass_fraction_floor = mass_fraction_floor
+        self.error_floor = error_floor
+        self._rng = np.random.default_rng(seed)
+        self._states: list[npt.NDArray[np.float64]] = []
+        self._results: list[npt.NDArray[np.float64]] = []
+        self._exact: dict[bytes, int] = {}
+        self._boxes: dict[tuple[int, ...], list[int]] = {}
+        self._disabled_boxes: set[tuple[int, ...]] = set()
+        self._verified_boxes: set[tuple[int, ...]] = set()
+        self.stats = {
+                "queries": 0,
+                "unique_states": 0,
+                "exact_hits": 0,
+                "near_hits": 0,
+                "misses": 0,
+                "fallbacks": 0,
+                "verifications": 0,
+                "failed_verifications": 0,
+                "corrections": 0,
+                "max_error": 0.0,
+                }
+
+    def _normalize(self, state: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+        return np.concatenate([
+            np.log(state[:2]),
+            np.log(np.maximum(state[2:], 0) + self.mass_fraction_floor),
+            ])
+
+    def _error(
+            self,
+            result: npt.NDArray[np.float64],
+            tabulated: npt.NDArray[np.float64],
+            ) -> float:
+        # Compare every component on its own scale so that large components
+        # like the heat release rate do not hide errors in the species rates
+        return float(np.max(
+            np.abs(result - tabulated) / (np.abs(result) + self.error_floor)
+            ))
+
+    def _box(self, state: npt.NDArray[np.float64]) -> tuple[int, ...]:
+        return tuple(np.floor(self._normalize(state) / self.tolerance).astype(np.int64))
+
+    def _insert(
+            self,
+            state: npt.NDArray[np.float64],
+            result: npt.NDArray[np.float64],
+            box: typing.Optional[tuple[int, ...]],
+            ) -> None:
+        if len(self._states) >= self.max_entries:
+            return
+        self._exact[state.tobytes()] = len(self._states)
+        if box is not None:
+            self._boxes.setdefault(box, []).append(len(self._states))
+        self._states.append(state.copy())
+        self._results.append(result)
+
+    def _lookup_or_evaluate(
+            self,
+            state: npt.NDArray[np.float64],
+            evaluate: typing.Callable[[npt.NDArray[np.float64]], npt.NDArray[np.float64]],
+            ) -> tuple[npt.NDArray[np.float64], typing.Optional[tuple[int, ...]]]:
+        # Returns the result and the box if it is a reuse of a nearby state
+        exact = self._exact.get(state.tobytes())
+        if exact is not None:
+            self.stats["exact_hits"] += 1
+            return self._results[exact], None
+        box = self._box(state) if self.tolerance > 0 else None
+        if box is not None and box in self._disabled_boxes:
+            self.stats["fallbacks"] += 1
+            return evaluate(state), None
+        candidates = self._boxes.get(box, []) if box is not None else []
+        if not candidates:
+            self.stats["misses"] += 1
+            result = evaluate(state)
+            self._insert(state, result, box)
+            return result, None
+        normalized = self._normalize(state)
+        nearest = min(
+                candidates,
+                key=lambda i: np.max(np.abs(self._normalize(self._states[i]) - normalized)),
+                )
+        tabulated = self._results[nearest]
+        if box in self._verified_boxes and self._rng.random() >= self.verify_fraction:
+            self.stats["near_hits"] += 1
+            return tabulated, box
+        # Check the tabulated result against the real one
+        self.stats["verifications"] += 1
+        result = evaluate(state)
+        error = self._error(result, tabulated)
+        self.stats["max_error"] = max(self.stats["max_error"], error)
+        if error > self.error_tolerance:
+            self.stats["failed_verifications"] += 1
+            self._disabled_boxes.add(box)
+        else:
+            self._verified_boxes.add(box)
+        self._insert(state, result, box)
+        return result, None
+
+    def evaluate(
+            self,
+            states: npt.NDArray[np.float64],
+            evaluate: typing.Callable[[npt.NDArray[np.float64]], npt.NDArray[np.float64]],
+            ) -> npt.NDArray[np.float64]:
+        # states has one row per cell and evaluate maps one row to its result
+        # Returns one row of results per cell
+        # Identical states within this call are only looked up once
+        unique_states, inverse = np.unique(states, axis=0, return_inverse=True)
+        self.stats["queries"] += len(states)
+        self.stats["unique_states"] += len(unique_states)
+        results = []
+        reused_boxes = []
+        for state in tqdm(unique_states):
+            result, box = self._lookup_or_evaluate(state, evaluate)
+            results.append(result)
+            reused_boxes.append(box)
+        if not results:
+            return np.empty((0, 0))
+        # A box may have failed a check after it answered some of the states
+        for row, box in enumerate(reused_boxes):
+            if box in self._disabled_boxes:
+                self.stats["corrections"] += 1
+                results[row] = evaluate(unique_states[row])
+                self._insert(unique_states[row], results[row], box)
+        return np.array(results)[inverse.reshape(-1)]
+
+    def summary(self) -> str:
+        queries = self.stats["queries"]
+        evaluations = (
+                self.stats["misses"]
+                + self.stats["fallbacks"]
+                + self.stats["verifications"]
+                + self.stats["corrections"]
+                )
+        hits = self.stats["exact_hits"] + self.stats["near_hits"]
+        unique_states = self.stats["unique_states"]
+        return (
+            f"Rate table: {len(self._states)} entries, "
+            f"this run: {queries} cells, {unique_states} unique states, "
+            f"{hits} reused ({self.stats['exact_hits']} exact, "
+            f"{self.stats['near_hits']} near), "
+            f"{evaluations} evaluated ({self.stats['fallbacks']} fallbacks, "
+            f"{self.stats['corrections']} corrections), "
+            f"{self.stats['failed_verifications']} / {self.stats['verifications']} "
+            f"verifications failed, max error {self.stats['max_error']:.2e}"
+        )
+
+    def save(self, filepath: Path) -> None:
+        table = {
+                "version": TABLE_VERSION,
+                "tolerance": self.tolerance,
+                "mass_fraction_floor": self.mass_fraction_floor,
+                "error_tolerance": self.error_tolerance,
+                "error_floor": self.error_floor,
+                "states": np.array(self._states),
+                "results": np.array(self._results),
+                "disabled_boxes": self._disabled_boxes,
+                "verified_boxes": self._verified_boxes,
+                }
+        write_pickle(filepath, table)
+
+    @classmethod
+    def load(
+            cls,
+            filepath: Path,
+            tolerance: float = 1e-4,
+            verify_fraction: float = 0.01,
+            error_tolerance: float = 1e-2,
+            max_entries: int = 500_000,
+            mass_fraction_floor: float = 1e-10,
+            error_floor: float | npt.NDArray[np.float64] = 1e-6,
+            ) -> "RateTable":
+        # Returns an empty table if filepath does not exist yet
+        rate_table = cls(
+                tolerance=tolerance,
+                verify_fraction=verify_fraction,
+                error_tolerance=error_tolerance,
+                max_entries=max_entries,
+                mass_fraction_floor=mass_fraction_floor,
+                error_floor=error_floor,
+                )
+        if not filepath.is_file():
+            return rate_table
+        table = load_versioned_pickle(filepath, TABLE_VERSION)
+        for state, result in zip(table["states"], table["results"]):
+            box = rate_table._box(state) if tolerance > 0 else None
+            rate_table._insert(state, result, box)
+        # Boxes depend on the tolerance and the floor and whether they passed a
+        # check depends on how the error was measured so the checked boxes
+        # only carry over if none of these has changed
+        if (
+                tolerance == table["tolerance"]
+                and mass_fraction_floor == table["mass_fraction_floor"]
+                and error_tolerance == table["error_tolerance"]
+                and np.array_equal(error_floor, table["error_floor"])
+                ):
+            rate_table._disabled_boxes = table["disabled_boxes"]
+            rate_table._verified_boxes = table["verified_boxes"]
+        # The stats only count what happens in this run
+        return rate_table
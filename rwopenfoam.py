@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-import pickle
+import io
 import argparse
 import textwrap
 import typing
@@ -8,7 +8,11 @@ import subprocess
 
 import numpy as np
 import numpy.typing as npt
-from tqdm import tqdm
+
+from case_catalog import list_times
+from cell_selection import select_cells
+from pickle_io import load_pickle, write_pickle
+from pipeline import run_pipelined
 
 
 def _list_to_dimensions(dimargs: list[str]) -> list[int]:
@@ -44,7 +48,14 @@ def _sanitize_uniform_value(args: list[str]) -> float | tuple[float]:
         )
 
 
-def read_variable(file_path: Path, num_cells: int) -> dict[str, typing.Any]:
+def read_variable(
+    file_path: Path,
+    num_cells: int,
+    cells: typing.Optional[npt.NDArray[np.int64]] = None,
+    text: typing.Optional[str] = None,
+) -> dict[str, typing.Any]:
+    # If cells is given, only the values of those cells are kept for vol fields
+    # If text is given, it is parsed instead of reading file_path
     data: dict[str, typing.Any] = {
         "type": None,
         "dimensions": None,
@@ -52,7 +63,9 @@ def read_variable(file_path: Path, num_cells: int) -> dict[str, typing.Any]:
     }
     found_values_start = False
     num_values = None
-    with open(file_path, "r") as infile:
+    keep = None
+    value_index = 0
+    with open(file_path, "r") if text is None else io.StringIO(text) as infile:
         for line in infile:
             match line.split():
                 case ["class", field_type]:
@@ -73,21 +86,28 @@ def read_variable(file_path: Path, num_cells: int) -> dict[str, typing.Any]:
                     num_values = int(num)
                     if data['type'] in ['volScalarField', 'volVectorField']:
                         assert num_values == num_cells, f'{file_path}: {num_values} == {num_cells}'
+                        if cells is not None:
+                            keep = np.zeros(num_values, dtype=bool)
+                            keep[cells] = True
                 case ["("]:
                     found_values_start = True
                 case [")"] if found_values_start:
-                    assert len(data["data"]) == num_values
+                    assert value_index == num_values
                     break
                 case [value] if found_values_start:
-                    data["data"].append(float(value))
+                    if keep is None or keep[value_index]:
+                        data["data"].append(float(value))
+                    value_index += 1
                 case [vx, vy, vz] if found_values_start:
-                    data["data"].append(
-                        (
-                            float(vx.split("(")[-1]),
-                            float(vy),
-                            float(vz.split(")")[0]),
+                    if keep is None or keep[value_index]:
+                        data["data"].append(
+                            (
+                                float(vx.split("(")[-1]),
+                                float(vy),
+                                float(vz.split(")")[0]),
+                            )
                         )
-                    )
+                    value_index += 1
     data["data"] = np.array(data["data"])
     return data
 
@@ -113,13 +133,42 @@ def read_species_list(kinetic_model_filepath: Path) -> list[str]:
     return species_list
 
 
-def openfoam_to_pickle(
+def get_num_cells() -> int:
+    # Figure out the number of cells in the domain
+    return int(subprocess.run(
+            [r"checkMesh | grep '^\s*cells:' | cut -d: -f2 | tr -d ' '"],
+            shell=True,
+            stdout=subprocess.PIPE,
+            ).stdout.decode().strip())
+
+
+def read_time_files(
+    timestamp: Path,
+    include_computed_quantities: bool = False,
+) -> dict[str, str]:
+    # Read the raw contents of the variable files in a timestamp
+    # This is all the I/O that load_openfoam_time needs so it can be done ahead
+    # of time in a separate thread
+    file_texts = {}
+    for var_file in timestamp.iterdir():
+        if var_file.is_dir():
+            continue
+        if var_file.name.endswith("_computed") and not include_computed_quantities:
+            continue
+        file_texts[var_file.name] = var_file.read_text()
+    return file_texts
+
+
+def load_openfoam_time(
     timestamp: Path,
-    pickle_filepath: Path,
     kinetic_model_filepath: typing.Optional[Path] = None,
     include_computed_quantities: bool = False,
-    force: bool = False,
-) -> None:
+    num_cells: typing.Optional[int] = None,
+    cell_specs: typing.Optional[list[str]] = None,
+    file_texts: typing.Optional[dict[str, str]] = None,
+) -> dict[str, typing.Any]:
+    # file_texts can hold the contents returned by read_time_files so that the
+    # files are not read again
     data: dict[str, npt.NDArray[np.float64] | float] = {}
     # Get the list of species from the kinetic model
     # This is done so that the species names can be prepended with a Y_
@@ -129,31 +178,72 @@ def openfoam_to_pickle(
         species_list = read_species_list(kinetic_model_filepath)
     else:
         species_list = []
-    # Figure out the number of cells in the domain
-    num_cells = int(subprocess.run(
-            [r"checkMesh | grep '^\s*cells:' | cut -d: -f2 | tr -d ' '"],
-            shell=True,
-            stdout=subprocess.PIPE,
-            ).stdout.decode().strip())
+    if num_cells is None:
+        num_cells = get_num_cells()
+    # Figure out which cells to keep
+    # Thresholds are evaluated on the fields of this timestamp
+    if cell_specs:
+        def read_field(var: str) -> typing.Any:
+            # The species files do not have the Y_ prefix
+            if var.startswith("Y_") and var[len("Y_"):] in species_list:
+                var = var[len("Y_"):]
+            return read_variable(
+                    timestamp / var,
+                    num_cells,
+                    text=file_texts[var] if file_texts is not None else None,
+                    )["data"]
+        cells = select_cells(
+                cell_specs,
+                case_dir=timestamp.parent,
+                num_cells=num_cells,
+                fields=read_field,
+                )
+    else:
+        cells = None
     # Load the data from the timestamp
-    for var_file in timestamp.iterdir():
-        if var_file.is_dir():
-            continue
-        var = var_file.name
+    if file_texts is None:
+        var_names = [f.name for f in timestamp.iterdir() if not f.is_dir()]
+    else:
+        var_names = list(file_texts)
+    for var_name in var_names:
+        var = var_name
         if var.endswith("_computed") and not include_computed_quantities:
             continue
         if species_list and var in species_list:
             var = f"Y_{var}"
-        data[var] = read_variable(var_file, num_cells)
-    if not force and pickle_filepath.exists():
-        raise FileExistsError(f"{pickle_filepath} already exists.")
+        data[var] = read_variable(
+                timestamp / var_name,
+                num_cells,
+                cells,
+                text=file_texts[var_name] if file_texts is not None else None,
+                )
     # Wrap the data in another dictionary containing some metadata as well
-    solution = {
+    # cells maps the stored values back to the cells of the mesh and is None
+    # if every cell is stored
+    return {
             'num_cells': num_cells,
+            'cells': cells,
             'data': data,
             }
-    with open(pickle_filepath, "wb") as pfile:
-        pickle.dump(solution, pfile)
+
+
+def openfoam_to_pickle(
+    timestamp: Path,
+    pickle_filepath: Path,
+    kinetic_model_filepath: typing.Optional[Path] = None,
+    include_computed_quantities: bool = False,
+    force: bool = False,
+    cell_specs: typing.Optional[list[str]] = None,
+) -> None:
+    solution = load_openfoam_time(
+            timestamp=timestamp,
+            kinetic_model_filepath=kinetic_model_filepath,
+            include_computed_quantities=include_computed_quantities,
+            cell_specs=cell_specs,
+            )
+    if not force and pickle_filepath.exists():
+        raise FileExistsError(f"{pickle_filepath} already exists.")
+    write_pickle(pickle_filepath, solution)
 
 
 def _write_openfoam_var_file(
@@ -246,9 +336,23 @@ def pickle_to_openfoam(
     solution_pickle: Path,
     timestamp: Path,
     auto_merge: bool = False,
+    fill_value: typing.Optional[float] = None,
 ) -> None:
-    with open(solution_pickle, "rb") as pfile:
-        data = pickle.load(pfile)
+    if solution_pickle.is_dir():
+        # This is a time-series store built by timeseries_store.py
+        # Pull the time that is being written out of it
+        from timeseries_store import load_time
+        data = load_time(solution_pickle, timestamp.name)
+    else:
+        data = load_pickle(solution_pickle)
+    # Check this before the time directory is created so that a failed
+    # conversion does not leave an empty time behind
+    cells = data.get('cells')
+    if cells is not None and fill_value is None:
+        raise ValueError(
+            f"{solution_pickle} only holds a subset of the cells. "
+            "A fill value is needed for the remaining cells."
+        )
     if timestamp.is_dir():
         if not auto_merge:
             print(
@@ -261,48 +365,85 @@ def pickle_to_openfoam(
     else:
         timestamp.mkdir()
     for var, values in data['data'].items():
+        if (
+                cells is not None
+                and values["type"].startswith("vol")
+                and isinstance(values["data"], np.ndarray)
+                ):
+            full_data = np.full(
+                    (data['num_cells'], *values["data"].shape[1:]),
+                    fill_value,
+                    )
+            full_data[cells] = values["data"]
+            values = {**values, "data": full_data}
         if (timestamp / var).is_file():
             print(f"{var} already exists in {timestamp}. Skipping.")
             continue
         _write_openfoam_var_file(timestamp / var, var, values)
 
 
+def list_time_dirs(case_dir: Path) -> list[Path]:
+    # The catalog keeps the sorted list of time directories between runs
+    return [case_dir / t for t in list_times(case_dir)]
+
+
+def _pickle_filepath(
+        case_dir: Path,
+        pickle_filepath_prefix: str,
+        time_dir: Path,
+        ) -> Path:
+    return case_dir / f"{pickle_filepath_prefix}{time_dir.name}.p"
+
+
 def pickle_all_openfoam_times(
         case_dir: Path,
         kinetic_model_filepath: Path,
         include_computed_quantities: bool = False,
         pickle_filepath_prefix: str = "ofsolution_",
         force: bool = False,
+        cell_specs: typing.Optional[list[str]] = None,
+        queue_depth: int = 2,
         ):
     # Create a list of the time directories that need to be processed
-    time_dirs = []
-    for time_dir in case_dir.iterdir():
-        pass
-    # Skip any non-time directories and other files
-        if not time_dir.is_dir():
-            continue
-        try:
-            float(time_dir.name)
-        except ValueError:
-            continue
-        time_dirs.append(time_dir)
-    # Sort the time directories in numerical order
-    time_dirs.sort(key=lambda p: float(p.name))
-    # Process all the time directories
-    for time_dir in tqdm(time_dirs):
-        pickle_filepath = (
-                case_dir / f"{pickle_filepath_prefix}{time_dir.name}.p"
+    time_dirs = [
+            time_dir for time_dir in list_time_dirs(case_dir)
+            if force or not _pickle_filepath(
+                case_dir, pickle_filepath_prefix, time_dir,
+                ).is_file()
+            ]
+    if not time_dirs:
+        return
+    # The mesh does not change between times so only run checkMesh once
+    num_cells = get_num_cells()
+
+    # Reading the files of the next time and writing the pickle of the
+    # previous time happen in the background while a time is being parsed
+    def load(time_dir: Path) -> dict[str, str]:
+        return read_time_files(time_dir, include_computed_quantities)
+
+    def compute(time_dir: Path, file_texts: dict[str, str]) -> dict[str, typing.Any]:
+        return load_openfoam_time(
+                timestamp=time_dir,
+                kinetic_model_filepath=kinetic_model_filepath,
+                include_computed_quantities=include_computed_quantities,
+                num_cells=num_cells,
+                cell_specs=cell_specs,
+                file_texts=file_texts,
                 )
-        if pickle_filepath.is_file() and not force:
-            continue
-        else:
-            openfoam_to_pickle(
-                    timestamp=time_dir,
-                    pickle_filepath=pickle_filepath,
-                    kinetic_model_filepath=kinetic_model_filepath,
-                    include_computed_quantities=include_computed_quantities,
-                    force=force,
-                    )
+
+    def write(time_dir: Path, solution: dict[str, typing.Any]) -> None:
+        pickle_filepath = _pickle_filepath(
+                case_dir, pickle_filepath_prefix, time_dir,
+                )
+        write_pickle(pickle_filepath, solution)
+
+    run_pipelined(
+            time_dirs,
+            load=load,
+            compute=compute,
+            write=write,
+            queue_depth=queue_depth,
+            )
 
 
 def main() -> None:
@@ -345,6 +486,21 @@ def main() -> None:
             help='overwrite pickle file if it already exists',
             action='store_true',
             )
+    parser_of2p.add_argument(
+            '--cells',
+            action='append',
+            metavar='SPEC',
+            help=(
+                'only keep the selected cells: bbox:xmin,ymin,zmin,xmax,ymax,zmax, '
+                'zone:NAME or a threshold like T>1200 (repeat to intersect)'
+                ),
+            )
+    parser_of2p.add_argument(
+            '--prefetch',
+            type=int,
+            default=2,
+            help='number of times to read ahead and write behind when timestamp is "all" (0 to disable)',
+            )
 
     parser_p2of = subparsers.add_parser(
             'p2of',
@@ -358,6 +514,11 @@ def main() -> None:
             help='merge with directory if directory already exists',
             action='store_true',
             )
+    parser_p2of.add_argument(
+            '--fill',
+            type=float,
+            help='value to write for cells that are not in a cell subset',
+            )
 
     args = parser.parse_args()
 
@@ -373,6 +534,8 @@ def main() -> None:
                     include_computed_quantities=args.include_computed,
                     pickle_filepath_prefix=args.pickle,
                     force=args.force,
+                    cell_specs=args.cells,
+                    queue_depth=args.prefetch,
                     )
         else:
             timestamp = args.case_dir / args.timestamp
@@ -383,6 +546,7 @@ def main() -> None:
                     kinetic_model_filepath=kinetic_model_filepath,
                     include_computed_quantities=args.include_computed,
                     force=args.force,
+                    cell_specs=args.cells,
                     )
     elif args.command == 'p2of':
         timestamp = args.case_dir / args.timestamp
@@ -391,6 +555,7 @@ def main() -> None:
                 solution_pickle=pickle_filepath,
                 timestamp=timestamp,
                 auto_merge=args.merge,
+                fill_value=args.fill,
                 )
     elif args.command is None:
         parser.print_usage()
@@ -1,23 +1,10 @@
 #!/bin/sh
 
-# dirs="$(ls -d processor* `ls -d 0.* | head -n-1`)"
-# echo "dirs:"
-# echo "$dirs"
-# echo
-# rm -rfI $dirs
+# Remove the decomposed time directories with six decimals below 0.1
+# (0.0?????) while keeping the latest time so that the case can be restarted
+# Any extra arguments (e.g. --dry-run) are passed on to prune_times.py
 
 set -e
 set -x
 
-# Get the last time
-lastTime=$(basename "$(ls -d processor0/0.* | tail -n1)")
-# Save the last time directory
-for dir in $(ls -d processor*); do
-  mv "$dir/$lastTime" "$dir/$lastTime".bk
-done
-# Remove all six digit directories
-rm -rf processor*/0.0?????
-# Restore the last time directory
-for dir in $(ls -d processor*); do
-  mv "$dir/$lastTime".bk "$dir/$lastTime"
-done
+python ~/bin/openfoam_utils/prune_times.py --only-matching '0.0?????' --keep-last 1 "$@"
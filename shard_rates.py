@@ -0,0 +1,518 @@
+#!/usr/bin/env python
+import sys
+import argparse
+import traceback
+import typing
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+from case_catalog import list_pickles
+from compute_reaction_rates import compute_rates, global_cells, select_positions
+from pickle_io import load_pickle, load_versioned_pickle, write_pickle
+
+# The rate computation of a case is split into shards of (time, chunk of cells)
+# Each shard writes its own partial result so that shards can run as the tasks
+# of a SLURM array or in local processes and be merged once all of them are done
+PLAN_FILENAME = "plan.p"
+PLAN_VERSION = 3
+SBATCH_TEMPLATE = Path(__file__).parent / "sbatch_files" / "rate_shards.sbatch.template"
+# SLURM rejects arrays with indices at or above MaxArraySize (1001 by default)
+# so several shards are run by each array task when there are more than this
+MAX_ARRAY_TASKS = 1000
+
+
+def _shard_filepath(shard_dir: Path, shard_id: int) -> Path:
+    return shard_dir / f"shard_{shard_id:06d}.p"
+
+
+def _failed_filepath(shard_dir: Path, shard_id: int) -> Path:
+    return shard_dir / f"shard_{shard_id:06d}.failed"
+
+
+def _positions_filepath(shard_dir: Path, time: str) -> Path:
+    return shard_dir / f"positions_{time}.npy"
+
+
+def _read_plan(shard_dir: Path) -> dict[str, typing.Any]:
+    return load_versioned_pickle(shard_dir / PLAN_FILENAME, PLAN_VERSION)
+
+
+def plan_shards(
+        *,
+        case_dir: Path,
+        shard_dir: Path,
+        state_data_pickle_prefix: str,
+        rate_data_pickle_prefix: str,
+        cells_per_shard: int = 50000,
+        cell_specs: typing.Optional[list[str]] = None,
+        shards_per_task: typing.Optional[int] = None,
+        force: bool = False,
+        ) -> dict[str, typing.Any]:
+    if (shard_dir / PLAN_FILENAME).is_file() and not force:
+        raise FileExistsError(
+            f"{shard_dir / PLAN_FILENAME} already exists. "
+            "Merge it or use force to start over."
+        )
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    # Results of an older plan do not belong to this one
+    for old_filepath in [
+            *shard_dir.glob("shard_*.p"),
+            *shard_dir.glob("shard_*.failed"),
+            *shard_dir.glob("positions_*.npy"),
+            ]:
+        old_filepath.unlink()
+    plan = {
+            "version": PLAN_VERSION,
+            "case_dir": str(case_dir.resolve()),
+            "times": {},
+            "shards": [],
+            }
+    state_data_pickles = list_pickles(case_dir, state_data_pickle_prefix)
+    # With --cells every state has to be loaded once to know how many cells it
+    # selects
+    # Without it only the first state is loaded and if it covers the whole
+    # mesh so are the rest (run_shard checks this when it loads them)
+    full_mesh = None
+    for state_data_pickle in tqdm(state_data_pickles):
+        time = state_data_pickle.stem[len(state_data_pickle_prefix):]
+        rate_data_pickle = case_dir / f"{rate_data_pickle_prefix}{time}.p"
+        # Skip the 0 time
+        if time == "0":
+            continue
+        if rate_data_pickle.is_file() and not force:
+            continue
+        if full_mesh is None or cell_specs:
+            state_data = load_pickle(state_data_pickle)
+            num_stored_cells, positions = select_positions(
+                    state_data,
+                    case_dir,
+                    cell_specs,
+                    )
+            num_cells = state_data["num_cells"]
+            all_cells = positions is None and state_data.get('cells') is None
+            if not cell_specs and all_cells:
+                full_mesh = num_cells
+            # Do not hold on to a state while the next one is loaded
+            del state_data
+        else:
+            num_stored_cells, positions = full_mesh, None
+            num_cells, all_cells = full_mesh, True
+        # Every array task reads the plan so it only holds ranges of positions
+        # The selected positions of a time (if any) go in a file of their own
+        # that a task only reads its range from
+        if positions is None:
+            num_positions = num_stored_cells
+        else:
+            num_positions = len(positions)
+            np.save(_positions_filepath(shard_dir, time), positions)
+        shard_ids = []
+        # Always make at least one shard so that every time gets a rate pickle
+        for start in range(0, max(num_positions, 1), cells_per_shard):
+            shard_ids.append(len(plan["shards"]))
+            plan["shards"].append({
+                "time": time,
+                "state_data_pickle": state_data_pickle.name,
+                "start": start,
+                "stop": min(start + cells_per_shard, num_positions),
+                })
+        plan["times"][time] = {
+                "rate_data_pickle": rate_data_pickle.name,
+                "num_cells": num_cells,
+                "num_stored_cells": num_stored_cells,
+                "all_cells": all_cells,
+                "selected": positions is not None,
+                "shards": shard_ids,
+                }
+    if shards_per_task is None:
+        shards_per_task = max(1, -(-len(plan["shards"]) // MAX_ARRAY_TASKS))
+    plan["shards_per_task"] = shards_per_task
+    write_pickle(shard_dir / PLAN_FILENAME, plan)
+    return plan
+
+
+def num_array_tasks(plan: dict[str, typing.Any]) -> int:
+    return -(-len(plan["shards"]) // plan["shards_per_task"])
+
+
+def task_shards(plan: dict[str, typing.Any], task_id: int) -> list[int]:
+    # The shards that array task task_id runs
+    start = task_id * plan["shards_per_task"]
+    return list(range(start, min(start + plan["shards_per_task"], len(plan["shards"]))))
+
+
+def shard_tasks(plan: dict[str, typing.Any], shard_ids: list[int]) -> list[int]:
+    # The array tasks that run shard_ids
+    return sorted({shard_id // plan["shards_per_task"] for shard_id in shard_ids})
+
+
+def write_sbatch(
+        sbatch_filepath: Path,
+        shard_dir: Path,
+        num_tasks: int,
+        max_concurrent: typing.Optional[int] = None,
+        ) -> None:
+    array_range = f"0-{num_tasks - 1}"
+    if max_concurrent:
+        array_range += f"%{max_concurrent}"
+    # The absolute shard directory lets the script be submitted from anywhere
+    sbatch = (
+            SBATCH_TEMPLATE.read_text()
+            .replace("<ARRAY_RANGE>", array_range)
+            .replace("<SHARD_DIR>", str(shard_dir.resolve()))
+            )
+    sbatch_filepath.write_text(sbatch)
+
+
+def _run_shard(
+        shard_dir: Path,
+        plan: dict[str, typing.Any],
+        shard_id: int,
+        state_data: dict[str, typing.Any],
+        ) -> None:
+    shard = plan["shards"][shard_id]
+    case_dir = Path(plan["case_dir"])
+    num_stored_cells, _ = select_positions(state_data, case_dir)
+    if num_stored_cells != plan["times"][shard["time"]]["num_stored_cells"]:
+        raise ValueError(
+            f"{shard['state_data_pickle']} holds {num_stored_cells} cells but "
+            f"the plan expects {plan['times'][shard['time']]['num_stored_cells']}. "
+            "Make a new plan."
+        )
+    if plan["times"][shard["time"]]["selected"]:
+        positions = np.load(
+                _positions_filepath(shard_dir, shard["time"]),
+                mmap_mode="r",
+                )[shard["start"]:shard["stop"]]
+        positions = np.array(positions)
+    else:
+        positions = np.arange(shard["start"], shard["stop"])
+    rate_data = compute_rates(
+            state_data["data"],
+            num_stored_cells,
+            positions,
+            )
+    write_pickle(
+            _shard_filepath(shard_dir, shard_id),
+            {
+                "shard": shard_id,
+                "cells": global_cells(state_data, positions),
+                "data": rate_data,
+                },
+            )
+    _failed_filepath(shard_dir, shard_id).unlink(missing_ok=True)
+
+
+def run_shards(shard_dir: Path, shard_ids: list[int]) -> list[int]:
+    # Returns the shards that failed
+    # Every shard is run even if one fails so that a task does as much as it can
+    # The traceback of a failed shard is kept next to where its result would be
+    # Consecutive shards of the same time share one load of its state
+    plan = _read_plan(shard_dir)
+    case_dir = Path(plan["case_dir"])
+    failed = []
+    loaded_pickle = None
+    state_data = None
+    for shard_id in shard_ids:
+        state_data_pickle = plan["shards"][shard_id]["state_data_pickle"]
+        try:
+            if state_data_pickle != loaded_pickle:
+                # Let go of the previous state before loading the next one
+                loaded_pickle, state_data = None, None
+                state_data = load_pickle(case_dir / state_data_pickle)
+                loaded_pickle = state_data_pickle
+            _run_shard(shard_dir, plan, shard_id, state_data)
+        except Exception:
+            _failed_filepath(shard_dir, shard_id).write_text(traceback.format_exc())
+            failed.append(shard_id)
+    return failed
+
+
+def run_shard(shard_dir: Path, shard_id: int) -> bool:
+    # Returns whether the shard succeeded
+    return not run_shards(shard_dir, [shard_id])
+
+
+def _run_shard_recording_failure(args: tuple[Path, int]) -> tuple[int, bool]:
+    shard_dir, shard_id = args
+    return shard_id, run_shard(shard_dir, shard_id)
+
+
+def shard_status(shard_dir: Path) -> dict[str, list[int]]:
+    plan = _read_plan(shard_dir)
+    status: dict[str, list[int]] = {"done": [], "failed": [], "missing": []}
+    for shard_id in range(len(plan["shards"])):
+        if _shard_filepath(shard_dir, shard_id).is_file():
+            status["done"].append(shard_id)
+        elif _failed_filepath(shard_dir, shard_id).is_file():
+            status["failed"].append(shard_id)
+        else:
+            status["missing"].append(shard_id)
+    return status
+
+
+def run_shards_locally(
+        shard_dir: Path,
+        shard_ids: list[int],
+        num_processes: int = 4,
+        ) -> list[int]:
+    # Returns the shards that failed
+    failed = []
+    with Pool(num_processes) as pool:
+        for shard_id, succeeded in tqdm(
+                pool.imap_unordered(
+                    _run_shard_recording_failure,
+                    [(shard_dir, shard_id) for shard_id in shard_ids],
+                    ),
+                total=len(shard_ids),
+                ):
+            if not succeeded:
+                failed.append(shard_id)
+    return sorted(failed)
+
+
+def merge_shards(shard_dir: Path, force: bool = False) -> None:
+    plan = _read_plan(shard_dir)
+    case_dir = Path(plan["case_dir"])
+    for time, info in tqdm(plan["times"].items()):
+        rate_data_pickle = case_dir / info["rate_data_pickle"]
+        if rate_data_pickle.is_file() and not force:
+            continue
+        parts = [
+                load_pickle(_shard_filepath(shard_dir, shard_id))
+                for shard_id in info["shards"]
+                ]
+        # The shards of a time hold consecutive chunks of its cells
+        rate_data = {}
+        for var, values in parts[0]["data"].items():
+            rate_data[var] = {
+                    "type": values["type"],
+                    "dimensions": values["dimensions"],
+                    "data": np.concatenate([p["data"][var]["data"] for p in parts]),
+                    }
+        if info["all_cells"]:
+            cells = None
+        else:
+            cells = np.concatenate([p["cells"] for p in parts])
+        write_pickle(
+                rate_data_pickle,
+                {
+                    "num_cells": info["num_cells"],
+                    "cells": cells,
+                    "data": rate_data,
+                    },
+                )
+
+
+def _format_ids(shard_ids: list[int]) -> str:
+    return ",".join(str(shard_id) for shard_id in shard_ids)
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(
+            prog='shard_rates',
+            description='Split the rate computation into shards for SLURM arrays or local processes',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            )
+    parser.add_argument(
+            '--case-dir',
+            type=Path,
+            default=Path('.'),
+            help='the OpenFOAM case directory',
+            )
+    parser.add_argument(
+            '--shard-dir',
+            default='rate_shards',
+            help='directory (inside the case directory) for the plan and the partial results',
+            )
+    subparsers = parser.add_subparsers(title='subcommands', dest='command')
+
+    parser_plan = subparsers.add_parser(
+            'plan',
+            help='Split the work into shards and write the SLURM array sbatch file',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            )
+    parser_plan.add_argument(
+            '-s',
+            '--solution-pickle-prefix',
+            default='ofsolution_',
+            help='prefix of the pickle file containing the OpenFOAM solution',
+            )
+    parser_plan.add_argument(
+            '-r',
+            '--rate-pickle-prefix',
+            default='computed_',
+            help='prefix of the pickle file to write computed rates to',
+            )
+    parser_plan.add_argument(
+            '-n',
+            '--cells-per-shard',
+            type=int,
+            default=50000,
+            help='maximum number of cells in a shard',
+            )
+    parser_plan.add_argument(
+            '--cells',
+            action='append',
+            metavar='SPEC',
+            help=(
+                'only compute the selected cells: bbox:xmin,ymin,zmin,xmax,ymax,zmax, '
+                'zone:NAME or a threshold like T>1200 (repeat to intersect)'
+                ),
+            )
+    parser_plan.add_argument(
+            '-k',
+            '--shards-per-task',
+            type=int,
+            help=(
+                'number of shards each array task runs '
+                f'(by default the fewest that keep the array within {MAX_ARRAY_TASKS} tasks)'
+                ),
+            )
+    parser_plan.add_argument(
+            '-m',
+            '--max-concurrent',
+            type=int,
+            help='maximum number of array tasks to run at the same time',
+            )
+    parser_plan.add_argument(
+            '-o',
+            '--sbatch',
+            default='rate_shards.sbatch',
+            help='the sbatch file to write (inside the case directory)',
+            )
+    parser_plan.add_argument(
+            '-f',
+            '--force',
+            help='replace an existing plan and include times that already have rate pickles',
+            action='store_true',
+            )
+
+    parser_run = subparsers.add_parser(
+            'run',
+            help='Run shards in this process (used by the array tasks)',
+            )
+    parser_run.add_argument('shard_ids', type=int, nargs='*', help='the shards to run')
+    parser_run.add_argument(
+            '-a',
+            '--array-task',
+            type=int,
+            help='also run the shards of this array task',
+            )
+
+    parser_local = subparsers.add_parser(
+            'local',
+            help='Run all unfinished shards in local processes',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            )
+    parser_local.add_argument(
+            '-j',
+            '--jobs',
+            type=int,
+            default=4,
+            help='number of processes',
+            )
+
+    subparsers.add_parser(
+            'status',
+            help='Count the finished, failed and missing shards',
+            )
+
+    parser_merge = subparsers.add_parser(
+            'merge',
+            help='Assemble the rate pickles from the shards',
+            )
+    parser_merge.add_argument(
+            '-j',
+            '--rerun-jobs',
+            type=int,
+            help='rerun failed and missing shards locally with this many processes first',
+            )
+    parser_merge.add_argument(
+            '-f',
+            '--force',
+            help='overwrite rate pickles that already exist',
+            action='store_true',
+            )
+
+    args = parser.parse_args()
+
+    shard_dir = args.case_dir / args.shard_dir
+    if args.command == 'plan':
+        plan = plan_shards(
+                case_dir=args.case_dir,
+                shard_dir=shard_dir,
+                state_data_pickle_prefix=args.solution_pickle_prefix,
+                rate_data_pickle_prefix=args.rate_pickle_prefix,
+                cells_per_shard=args.cells_per_shard,
+                cell_specs=args.cells,
+                shards_per_task=args.shards_per_task,
+                force=args.force,
+                )
+        num_shards = len(plan["shards"])
+        num_tasks = num_array_tasks(plan)
+        print(
+            f"{num_shards} shards over {len(plan['times'])} times "
+            f"in {num_tasks} array tasks of {plan['shards_per_task']} shards"
+            )
+        if num_shards:
+            sbatch_filepath = args.case_dir / args.sbatch
+            write_sbatch(
+                    sbatch_filepath,
+                    shard_dir,
+                    num_tasks,
+                    args.max_concurrent,
+                    )
+            print(f"Fill in the <ENTER_..._HERE> fields in {sbatch_filepath} and submit it with sbatch")
+    elif args.command == 'run':
+        shard_ids = list(args.shard_ids)
+        if args.array_task is not None:
+            shard_ids += task_shards(_read_plan(shard_dir), args.array_task)
+        failed = run_shards(shard_dir, shard_ids)
+        for shard_id in failed:
+            print(_failed_filepath(shard_dir, shard_id).read_text(), file=sys.stderr)
+        if failed:
+            print(f"Failed shards: {_format_ids(failed)}", file=sys.stderr)
+            sys.exit(1)
+    elif args.command == 'local':
+        status = shard_status(shard_dir)
+        failed = run_shards_locally(
+                shard_dir,
+                status["failed"] + status["missing"],
+                args.jobs,
+                )
+        if failed:
+            print(f"Failed shards: {_format_ids(failed)}")
+            sys.exit(1)
+    elif args.command == 'status':
+        status = shard_status(shard_dir)
+        for state, shard_ids in status.items():
+            print(f"{state}: {len(shard_ids)}")
+        if status["failed"]:
+            print(f"Failed shards: {_format_ids(status['failed'])}")
+    elif args.command == 'merge':
+        status = shard_status(shard_dir)
+        unfinished = sorted(status["failed"] + status["missing"])
+        if unfinished and args.rerun_jobs:
+            unfinished = run_shards_locally(shard_dir, unfinished, args.rerun_jobs)
+        if unfinished:
+            print(f"{len(unfinished)} shards are not finished.")
+            print("Rerun them with --rerun-jobs or resubmit their array tasks with")
+            print(
+                "  sbatch "
+                f"--array={_format_ids(shard_tasks(_read_plan(shard_dir), unfinished))} "
+                "<sbatch file>"
+                )
+            sys.exit(1)
+        merge_shards(shard_dir, force=args.force)
+    elif args.command is None:
+        parser.print_usage()
+    else:
+        raise ValueError(f'Unknown command {args.command}')
+
+
+if __name__ == "__main__":
+    main()
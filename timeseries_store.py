@@ -0,0 +1,464 @@
+#!/usr/bin/env python
+import zlib
+import argparse
+import typing
+from pathlib import Path
+
+import numpy as np
+import numpy.typing as npt
+from tqdm import tqdm
+
+from case_catalog import list_pickles
+from pickle_io import load_pickle, load_versioned_pickle, write_pickle
+from rwopenfoam import get_num_cells, list_time_dirs, load_openfoam_time
+
+# A store is a directory with an index and one file per time
+# Every keyframe_interval-th time is a keyframe which can be decoded on its own
+# All other times only hold the difference to the time before them so reading
+# a time means decoding forward from the nearest keyframe before it
+INDEX_FILENAME = "index.p"
+FRAMES_DIRNAME = "frames"
+STORE_VERSION = 1
+
+
+def _shuffle(values: npt.NDArray[typing.Any]) -> bytes:
+    # Group the n-th byte of every value together
+    # Neighbouring values (and XOR/integer deltas between times) mostly share
+    # their high bytes so this makes long runs that zlib compresses well
+    itemsize = values.dtype.itemsize
+    return zlib.compress(
+            np.ascontiguousarray(values)
+            .view(np.uint8)
+            .reshape(-1, itemsize)
+            .T
+            .tobytes()
+            )
+
+
+def _unshuffle(
+        payload: bytes,
+        dtype: np.dtype,
+        shape: tuple[int, ...],
+        ) -> npt.NDArray[typing.Any]:
+    itemsize = np.dtype(dtype).itemsize
+    return (
+            np.frombuffer(zlib.decompress(payload), dtype=np.uint8)
+            .reshape(itemsize, -1)
+            .T
+            .copy()
+            .view(dtype)
+            .reshape(shape)
+            )
+
+
+def _quantize(values: npt.NDArray[np.float64], step: float) -> npt.NDArray[np.int64]:
+    return np.rint(values / step).astype(np.int64)
+
+
+def _can_quantize(values: npt.NDArray[np.float64], step: float) -> bool:
+    # NaN, inf and values too large for int64 at this step cannot be quantized
+    # so such fields are stored losslessly instead
+    with np.errstate(invalid="ignore", over="ignore"):
+        return bool(np.all(np.abs(values / step) < 2**62))
+
+
+def _encode_field(
+        values: typing.Any,
+        reference: npt.NDArray[typing.Any] | None,
+        step: float | None,
+        ) -> tuple[dict[str, typing.Any], npt.NDArray[typing.Any] | None]:
+    # Returns the encoded field and the reference that the next time should be
+    # encoded against
+    # The reference is exactly what the decoder will reconstruct so that
+    # quantization errors do not accumulate along the chain of deltas
+    if not isinstance(values, np.ndarray):
+        # Uniform values are tiny so they are always stored as they are
+        return {"kind": "uniform", "value": values}, None
+    if step is not None and values.dtype == np.float64 \
+            and _can_quantize(values, step):
+        quantized = _quantize(values, step)
+        if reference is not None and reference.shape == quantized.shape \
+                and reference.dtype == np.int64:
+            kind, stored = "qdelta", quantized - reference
+        else:
+            kind, stored = "qraw", quantized
+        encoded = {
+                "kind": kind,
+                "step": step,
+                "dtype": stored.dtype.str,
+                "shape": stored.shape,
+                "payload": _shuffle(stored),
+                }
+        return encoded, quantized
+    if values.dtype == np.float64 and reference is not None \
+            and reference.shape == values.shape \
+            and reference.dtype == np.float64:
+        # XOR of the bit patterns is exactly reversible unlike subtraction
+        kind = "xor"
+        stored = values.view(np.uint64) ^ reference.view(np.uint64)
+    else:
+        kind = "raw"
+        stored = values
+    encoded = {
+            "kind": kind,
+            "dtype": stored.dtype.str,
+            "shape": stored.shape,
+            "payload": _shuffle(stored),
+            }
+    return encoded, values
+
+
+def _decode_field(
+        encoded: dict[str, typing.Any],
+        reference: npt.NDArray[typing.Any] | None,
+        ) -> tuple[typing.Any, npt.NDArray[typing.Any] | None]:
+    # Returns the decoded values and the reference for the next time
+    kind = encoded["kind"]
+    if kind == "uniform":
+        return encoded["value"], None
+    stored = _unshuffle(
+            encoded["payload"],
+            np.dtype(encoded["dtype"]),
+            tuple(encoded["shape"]),
+            )
+    if kind == "raw":
+        return stored, stored
+    elif kind == "xor":
+        values = (reference.view(np.uint64) ^ stored).view(np.float64)
+        return values, values
+    elif kind == "qraw":
+        return stored * encoded["step"], stored
+    elif kind == "qdelta":
+        quantized = reference + stored
+        return quantized * encoded["step"], quantized
+    raise ValueError(f"Unknown field encoding {kind}")
+
+
+def _read_index(store_dir: Path) -> dict[str, typing.Any]:
+    return load_versioned_pickle(store_dir / INDEX_FILENAME, STORE_VERSION)
+
+
+def _frame_filepath(store_dir: Path, time: str) -> Path:
+    return store_dir / FRAMES_DIRNAME / f"{time}.p"
+
+
+def _decode_frames(
+        store_dir: Path,
+        index: dict[str, typing.Any],
+        position: int,
+        ) -> tuple[dict[str, typing.Any], dict[str, typing.Any]]:
+    # Decode forward from the nearest keyframe at or before position
+    # Returns the solution at position and the references for the next time
+    keyframe = position
+    while not index["keyframes"][keyframe]:
+        keyframe -= 1
+    references: dict[str, typing.Any] = {}
+    solution: dict[str, typing.Any] = {}
+    for time in index["times"][keyframe:position + 1]:
+        frame = load_pickle(_frame_filepath(store_dir, time))
+        data = {}
+        next_references = {}
+        for var, field in frame["fields"].items():
+            values, next_references[var] = _decode_field(
+                    field["encoded"],
+                    references.get(var),
+                    )
+            data[var] = {
+                    "type": field["type"],
+                    "dimensions": field["dimensions"],
+                    "data": values,
+                    }
+        references = next_references
+        solution = {**frame["metadata"], "data": data}
+    return solution, references
+
+
+def list_times(store_dir: Path) -> list[str]:
+    return list(_read_index(store_dir)["times"])
+
+
+def load_time(store_dir: Path, time: str) -> dict[str, typing.Any]:
+    # Returns the same dictionary that openfoam_to_pickle writes out
+    index = _read_index(store_dir)
+    try:
+        position = index["times"].index(time)
+    except ValueError:
+        # Allow the time to be specified in a different format, e.g. 1e-4
+        matches = [
+                i for i, t in enumerate(index["times"])
+                if float(t) == float(time)
+                ]
+        if not matches:
+            raise KeyError(f"Time {time} is not in {store_dir}")
+        position = matches[0]
+    solution, _ = _decode_frames(store_dir, index, position)
+    return solution
+
+
+def append_times(
+        store_dir: Path,
+        sources: list[tuple[str, typing.Callable[[], dict[str, typing.Any]]]],
+        keyframe_interval: typing.Optional[int] = None,
+        quantization_steps: typing.Optional[dict[str, float]] = None,
+        ) -> None:
+    # sources is a list of (time, loader) pairs in increasing time order where
+    # calling loader returns the solution dictionary for that time
+    # Times that are already in the store are skipped
+    # keyframe_interval and quantization_steps default to those of an existing
+    # store (or every 10th time and lossless for a new one)
+    if (store_dir / INDEX_FILENAME).is_file():
+        index = _read_index(store_dir)
+        if keyframe_interval is not None \
+                and keyframe_interval != index["keyframe_interval"]:
+            raise ValueError(
+                f"{store_dir} was built with keyframe interval "
+                f"{index['keyframe_interval']}, not {keyframe_interval}"
+            )
+        if quantization_steps is not None \
+                and quantization_steps != index["quantization_steps"]:
+            raise ValueError(
+                f"{store_dir} was built with quantization steps "
+                f"{index['quantization_steps']}, not {quantization_steps}"
+            )
+    else:
+        (store_dir / FRAMES_DIRNAME).mkdir(parents=True, exist_ok=True)
+        index = {
+                "version": STORE_VERSION,
+                "keyframe_interval": keyframe_interval or 10,
+                "quantization_steps": quantization_steps or {},
+                "times": [],
+                "keyframes": [],
+                }
+    existing_times = set(index["times"])
+    sources = [(t, loader) for t, loader in sources if t not in existing_times]
+    if not sources:
+        return
+    if index["times"] and float(sources[0][0]) < float(index["times"][-1]):
+        raise ValueError(
+            f"Cannot add time {sources[0][0]} before the last time "
+            f"{index['times'][-1]} in {store_dir}"
+        )
+    if index["times"]:
+        _, references = _decode_frames(
+                store_dir,
+                index,
+                len(index["times"]) - 1,
+                )
+    else:
+        references = {}
+    steps = index["quantization_steps"]
+    for time, loader in tqdm(sources):
+        solution = loader()
+        is_keyframe = len(index["times"]) % index["keyframe_interval"] == 0
+        if is_keyframe:
+            references = {}
+        fields = {}
+        next_references = {}
+        for var, values in solution["data"].items():
+            encoded, next_references[var] = _encode_field(
+                    values["data"],
+                    references.get(var),
+                    steps.get(var),
+                    )
+            fields[var] = {
+                    "type": values["type"],
+                    "dimensions": values["dimensions"],
+                    "encoded": encoded,
+                    }
+        references = next_references
+        frame = {
+                "metadata": {k: v for k, v in solution.items() if k != "data"},
+                "fields": fields,
+                }
+        write_pickle(_frame_filepath(store_dir, time), frame)
+        index["times"].append(time)
+        index["keyframes"].append(is_keyframe)
+        write_pickle(store_dir / INDEX_FILENAME, index)
+
+
+def _pickle_loader(pickle_filepath: Path) -> typing.Callable[[], dict[str, typing.Any]]:
+    def loader() -> dict[str, typing.Any]:
+        return load_pickle(pickle_filepath)
+    return loader
+
+
+def pickle_sources(
+        case_dir: Path,
+        pickle_filepath_prefix: str = "ofsolution_",
+        ) -> list[tuple[str, typing.Callable[[], dict[str, typing.Any]]]]:
+    return [
+            (p.stem[len(pickle_filepath_prefix):], _pickle_loader(p))
+            for p in list_pickles(case_dir, pickle_filepath_prefix)
+            ]
+
+
+def time_dir_sources(
+        case_dir: Path,
+        kinetic_model_filepath: typing.Optional[Path] = None,
+        include_computed_quantities: bool = False,
+        ) -> list[tuple[str, typing.Callable[[], dict[str, typing.Any]]]]:
+    time_dirs = list_time_dirs(case_dir)
+    # The mesh does not change between times so only run checkMesh once
+    num_cells = get_num_cells() if time_dirs else 0
+
+    def make_loader(time_dir: Path) -> typing.Callable[[], dict[str, typing.Any]]:
+        def loader() -> dict[str, typing.Any]:
+            return load_openfoam_time(
+                    timestamp=time_dir,
+                    kinetic_model_filepath=kinetic_model_filepath,
+                    include_computed_quantities=include_computed_quantities,
+                    num_cells=num_cells,
+                    )
+        return loader
+
+    return [(p.name, make_loader(p)) for p in time_dirs]
+
+
+def _parse_quantization(specs: list[str]) -> dict[str, float]:
+    # Each spec is var=max_abs_error
+    # Rounding to a grid of spacing 2*max_abs_error keeps every value within
+    # max_abs_error of the original
+    steps = {}
+    for spec in specs:
+        var, _, error = spec.partition("=")
+        if not var or not error:
+            raise ValueError(f"Quantization must be given as var=error: {spec}")
+        steps[var] = 2 * float(error)
+    return steps
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(
+            prog='timeseries_store',
+            description='Store OpenFOAM times as keyframes plus compressed deltas',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            )
+    parser.add_argument(
+            '--case-dir',
+            type=Path,
+            default=Path('.'),
+            help='the OpenFOAM case directory',
+            )
+    subparsers = parser.add_subparsers(title='subcommands', dest='command')
+
+    parser_build = subparsers.add_parser(
+            'build',
+            help='Create a store or add new times to it',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            )
+    parser_build.add_argument('store', help='the store directory')
+    source = parser_build.add_mutually_exclusive_group(required=True)
+    source.add_argument(
+            '-p',
+            '--from-pickles',
+            metavar='PREFIX',
+            help='read the times from pickles written by rwopenfoam of2p',
+            )
+    source.add_argument(
+            '-t',
+            '--from-times',
+            help='read the times directly from the time directories',
+            action='store_true',
+            )
+    parser_build.add_argument(
+            '-k',
+            '--kinetics',
+            help='the kinetic model to extract species from (with --from-times)',
+            )
+    parser_build.add_argument(
+            '-c',
+            '--include-computed',
+            help='include computed quantities (with --from-times)',
+            action='store_true',
+            )
+    parser_build.add_argument(
+            '-i',
+            '--keyframe-interval',
+            type=int,
+            help='number of times between keyframes (10 for a new store)',
+            )
+    parser_build.add_argument(
+            '-q',
+            '--quantize',
+            action='append',
+            default=[],
+            metavar='VAR=ERROR',
+            help='store VAR with at most ERROR absolute error (lossless if not given)',
+            )
+
+    parser_extract = subparsers.add_parser(
+            'extract',
+            help='Write one time from the store to a pickle',
+            )
+    parser_extract.add_argument('store', help='the store directory')
+    parser_extract.add_argument('timestamp', help='the time to extract')
+    parser_extract.add_argument('pickle', help='the pickle file to write to')
+    parser_extract.add_argument(
+            '-f',
+            '--force',
+            help='overwrite pickle file if it already exists',
+            action='store_true',
+            )
+
+    parser_info = subparsers.add_parser(
+            'info',
+            help='Print the times in the store and its size',
+            )
+    parser_info.add_argument('store', help='the store directory')
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        store_dir = args.case_dir / args.store
+        if args.from_pickles:
+            sources = pickle_sources(args.case_dir, args.from_pickles)
+        else:
+            if args.kinetics:
+                kinetic_model_filepath = args.case_dir / args.kinetics
+            else:
+                kinetic_model_filepath = None
+            sources = time_dir_sources(
+                    args.case_dir,
+                    kinetic_model_filepath=kinetic_model_filepath,
+                    include_computed_quantities=args.include_computed,
+                    )
+        append_times(
+                store_dir,
+                sources,
+                keyframe_interval=args.keyframe_interval,
+                quantization_steps=(
+                    _parse_quantization(args.quantize)
+                    if args.quantize else None
+                    ),
+                )
+    elif args.command == 'extract':
+        store_dir = args.case_dir / args.store
+        pickle_filepath = args.case_dir / args.pickle
+        if pickle_filepath.exists() and not args.force:
+            raise FileExistsError(f"{pickle_filepath} already exists.")
+        solution = load_time(store_dir, args.timestamp)
+        write_pickle(pickle_filepath, solution)
+    elif args.command == 'info':
+        store_dir = args.case_dir / args.store
+        index = _read_index(store_dir)
+        size = sum(
+                p.stat().st_size
+                for p in (store_dir / FRAMES_DIRNAME).iterdir()
+                )
+        print(f"Times: {len(index['times'])}")
+        print(f"Keyframes: {sum(index['keyframes'])}")
+        print(f"Keyframe interval: {index['keyframe_interval']}")
+        print(f"Quantization steps: {index['quantization_steps'] or 'lossless'}")
+        print(f"Size on disk: {size / 2**20:.1f} MiB")
+        if index["times"]:
+            print(f"First time: {index['times'][0]}")
+            print(f"Last time: {index['times'][-1]}")
+    elif args.command is None:
+        parser.print_usage()
+    else:
+        raise ValueError(f'Unknown command {args.command}')
+
+
+if __name__ == "__main__":
+    main()